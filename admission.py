@@ -0,0 +1,304 @@
+"""
+Admission control: keep front-desk calls fast while reports run.
+
+Every request is put in one of two classes:
+
+* ``heavy``: analytics, exports, imports, delta sync and NDJSON streams.
+  These hold a database connection and a worker thread for a long time.
+* ``interactive``: everything else, such as looking up a patient or
+  recording a visit.
+
+Each class has its own concurrency limit and a bounded FIFO wait queue. A
+storm of reports therefore fills only the heavy slots; the interactive slots
+stay free. If a request finds its class's queue full, or waits longer than
+the queue timeout, it is rejected at once with ``503`` and ``Retry-After``
+rather than timing out later. Each client (tenant + address) also has a
+token-bucket rate limit per class; over the limit it gets ``429``. Delta
+sync calls that carry a ``since`` token are not rate-limited, so a client
+catching up page by page is never cut off halfway; they still take a slot.
+
+Database statements run by heavy requests are time-limited: PostgreSQL gets
+``SET LOCAL statement_timeout`` at the start of each transaction. SQLite has
+no per-statement timeout, so there a progress handler interrupts any
+statement that has been running for that long. NDJSON streams are left
+alone on SQLite: their one statement stays open while the client reads, so
+its age says nothing about the database work.
+
+The limiter state is per process and visible at ``GET /admin/admission``.
+The SSE dashboard stream is exempt, since it stays open indefinitely.
+"""
+
+import asyncio
+import collections
+import contextvars
+import json
+import math
+import os
+import time
+from urllib.parse import parse_qsl
+
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+import tenancy
+
+EXEMPT_PATHS = {"/", "/docs", "/docs/oauth2-redirect", "/redoc", "/openapi.json", "/analytics/stream", "/admin/admission"}
+HEAVY_PREFIXES = ("/analytics/", "/export/", "/import/", "/sync")
+# Clients behind a reverse proxy are told apart by X-Forwarded-For
+TRUST_FORWARDED_FOR = os.getenv("ADMISSION_TRUST_FORWARDED_FOR", "").lower() in ("1", "true", "yes")
+MAX_TRACKED_CLIENTS = int(os.getenv("ADMISSION_MAX_TRACKED_CLIENTS", "10000"))
+
+_statement_timeout = contextvars.ContextVar("statement_timeout", default=None)
+# Seconds a SQLite statement may run; None for streamed responses
+_sqlite_statement_timeout = contextvars.ContextVar("sqlite_statement_timeout", default=None)
+
+
+def _setting(request_class: str, name: str, default: float):
+    return float(os.getenv(f"ADMISSION_{request_class.upper()}_{name}", str(default)))
+
+
+class ClassLimiter:
+    def __init__(self, name: str, concurrency: int, max_queue: int, queue_timeout: float,
+                 rate: float, burst: float, statement_timeout: float = 0):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rate = rate  # requests per second per client; 0 disables the rate limit
+        self.burst = burst
+        self.statement_timeout = statement_timeout  # seconds; 0 disables it
+        self.active = 0
+        self._waiters = collections.deque()
+        self._buckets = collections.OrderedDict()  # client -> (tokens, last refill)
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.rate_limited = 0
+
+    def check_rate(self, client: str):
+        """Take a token for the client; returns 0, or the seconds until one is available."""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        tokens, last = self._buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0
+        else:
+            wait = (1 - tokens) / self.rate
+            self.rate_limited += 1
+        self._buckets[client] = (tokens, now)
+        while len(self._buckets) > MAX_TRACKED_CLIENTS:
+            self._buckets.popitem(last=False)
+        return wait
+
+    async def acquire(self):
+        """Wait for a slot in FIFO order; False when the queue is full or the wait times out."""
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return True
+        if len(self._waiters) >= self.max_queue:
+            self.rejected_queue_full += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except BaseException as e:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the wait ended; pass it on
+                self.release()
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected_timeout += 1
+                return False
+            raise
+        self.admitted += 1
+        return True
+
+    def release(self):
+        # Hand the slot straight to the next waiter, so it cannot be overtaken
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.active -= 1
+
+    def stats(self):
+        return {
+            "concurrency": self.concurrency,
+            "active": self.active,
+            "waiting": len(self._waiters),
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "rate_per_client": self.rate,
+            "burst_per_client": self.burst,
+            "statement_timeout": self.statement_timeout,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "rate_limited": self.rate_limited,
+            "tracked_clients": len(self._buckets),
+        }
+
+
+# Heavy slots stay well below the database pool size (5 + 10 overflow by
+# default), leaving connections for interactive calls
+LIMITERS = {
+    "heavy": ClassLimiter(
+        "heavy",
+        concurrency=int(_setting("heavy", "CONCURRENCY", 2)),
+        max_queue=int(_setting("heavy", "QUEUE", 8)),
+        queue_timeout=_setting("heavy", "QUEUE_TIMEOUT", 10),
+        # Room for a dashboard poll from each of several screens sharing one address
+        rate=_setting("heavy", "RATE", 2),
+        burst=_setting("heavy", "BURST", 20),
+        statement_timeout=_setting("heavy", "STATEMENT_TIMEOUT", 30),
+    ),
+    "interactive": ClassLimiter(
+        "interactive",
+        concurrency=int(_setting("interactive", "CONCURRENCY", 32)),
+        max_queue=int(_setting("interactive", "QUEUE", 128)),
+        queue_timeout=_setting("interactive", "QUEUE_TIMEOUT", 5),
+        rate=_setting("interactive", "RATE", 20),
+        burst=_setting("interactive", "BURST", 40),
+    ),
+}
+
+
+_BOOL = TypeAdapter(bool)
+
+
+def is_stream(query_string: str, headers):
+    """Whether a list endpoint will stream NDJSON; main.py decides with this same check."""
+    if "application/x-ndjson" in headers.get("accept", ""):
+        return True
+    # Parsed like the endpoints' `stream: bool` parameter: the last value, with pydantic's bool rules
+    values = [value for name, value in parse_qsl(query_string, keep_blank_values=True) if name == "stream"]
+    if not values:
+        return False
+    try:
+        return _BOOL.validate_python(values[-1])
+    except ValidationError:
+        return False
+
+
+def classify(method: str, path: str, query_string: str, headers):
+    if path in EXEMPT_PATHS or method == "OPTIONS":
+        return None
+    if path.startswith(HEAVY_PREFIXES):
+        return "heavy"
+    # NDJSON streams hold a connection for the whole result set
+    if is_stream(query_string, headers):
+        return "heavy"
+    return "interactive"
+
+
+def is_rate_limited(path: str, query_string: str):
+    # Delta sync pages follow each other until has_more is false
+    return not (path == "/sync" and any(param.startswith("since=") for param in query_string.split("&")))
+
+
+def client_key(scope, headers):
+    address = scope["client"][0] if scope.get("client") else "unknown"
+    if TRUST_FORWARDED_FOR and headers.get("x-forwarded-for"):
+        address = headers["x-forwarded-for"].split(",", 1)[0].strip()
+    return f"{tenancy.current_tenant()}:{address}"
+
+
+def stats():
+    return {name: limiter.stats() for name, limiter in LIMITERS.items()}
+
+
+class AdmissionMiddleware:
+    """Pure ASGI middleware applying the per-class limits to each request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+        query_string = scope.get("query_string", b"").decode("latin-1")
+        request_class = classify(scope["method"], scope["path"], query_string, headers)
+        if request_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        limiter = LIMITERS[request_class]
+        wait = limiter.check_rate(client_key(scope, headers)) if is_rate_limited(scope["path"], query_string) else 0
+        if wait:
+            await _reject(send, 429, "Too many requests", wait)
+            return
+        if not await limiter.acquire():
+            await _reject(send, 503, f"Server busy with {request_class} requests", limiter.queue_timeout)
+            return
+
+        timeout_token = sqlite_token = None
+        if limiter.statement_timeout:
+            timeout_token = _statement_timeout.set(limiter.statement_timeout)
+            if not is_stream(query_string, headers):
+                sqlite_token = _sqlite_statement_timeout.set(limiter.statement_timeout)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if timeout_token is not None:
+                _statement_timeout.reset(timeout_token)
+            if sqlite_token is not None:
+                _sqlite_statement_timeout.reset(sqlite_token)
+            limiter.release()
+
+
+async def _reject(send, status: int, detail: str, retry_after: float):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+@event.listens_for(Session, "after_begin")
+def _apply_statement_timeout(session, transaction, connection):
+    timeout = _statement_timeout.get()
+    if timeout and connection.dialect.name == "postgresql":
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout * 1000)}")
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _limit_sqlite_statement(conn, cursor, statement, parameters, context, executemany):
+    if conn.dialect.name != "sqlite":
+        return
+    timeout = _sqlite_statement_timeout.get()
+    driver_connection = conn.connection.driver_connection
+    if timeout:
+        # The deadline starts with this statement; a non-zero return aborts it
+        deadline = time.monotonic() + timeout
+        driver_connection.set_progress_handler(lambda: 1 if time.monotonic() > deadline else 0, 10000)
+        conn.info["progress_handler"] = True
+    elif conn.info.pop("progress_handler", False):
+        # The pooled connection may have come from a time-limited request
+        driver_connection.set_progress_handler(None, 10000)
+
+
+def is_statement_timeout(exc):
+    message = str(getattr(exc, "orig", exc)).lower()
+    return "statement timeout" in message or "interrupted" in message
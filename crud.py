@@ -1,25 +1,56 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import func, and_, extract
-from datetime import datetime, timedelta, date
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import func, and_, or_, DateTime
+from datetime import datetime, timedelta, date, time
 from typing import List, Optional
+import base64
+import csv
+import json
+import os
 import pandas as pd
-import database, schemas
+import database, schemas, events, partitioning, search, terms
 
 # Patient CRUD operations
 def get_patient(db: Session, patient_id: int):
     return db.query(database.Patient).filter(database.Patient.id == patient_id).first()
 
-def get_patients(db: Session, skip: int = 0, limit: int = 100, search: Optional[str] = None):
+PATIENT_SORT_FIELDS = {
+    "name": database.Patient.name,
+    "created_at": database.Patient.created_at,
+    "visit_count": database.PatientCounters.visit_count,
+    "appointment_count": database.PatientCounters.appointment_count,
+    "payment_total": database.PatientCounters.payment_total,
+    "last_visit_date": database.PatientCounters.last_visit_date,
+    "next_visit_date": database.PatientCounters.next_visit_date,
+}
+
+def get_patients(db: Session, skip: int = 0, limit: int = 100, search: Optional[str] = None, sort_by: Optional[str] = None, order: str = "asc"):
+    return _patients_query(db, search, sort_by, order).offset(skip).limit(limit).all()
+
+def stream_patients(db: Session, skip: int = 0, limit: Optional[int] = None, search: Optional[str] = None, sort_by: Optional[str] = None, order: str = "asc"):
+    return stream_rows([_patients_query(db, search, sort_by, order)], skip, limit)
+
+def _patients_query(db: Session, search: Optional[str] = None, sort_by: Optional[str] = None, order: str = "asc"):
     query = db.query(database.Patient)
     if search:
         query = query.filter(database.Patient.name.ilike(f"%{search}%"))
-    return query.offset(skip).limit(limit).all()
+    if sort_by:
+        if sort_by not in PATIENT_SORT_FIELDS:
+            raise ValueError(f"Cannot sort by '{sort_by}', expected one of: {', '.join(PATIENT_SORT_FIELDS)}")
+        if order not in ("asc", "desc"):
+            raise ValueError("order must be 'asc' or 'desc'")
+        column = PATIENT_SORT_FIELDS[sort_by]
+        if column.class_ is database.PatientCounters:
+            query = query.outerjoin(database.PatientCounters)
+        direction = column.desc() if order == "desc" else column.asc()
+        query = query.order_by(direction.nulls_last(), database.Patient.id)
+    return query
 
 def create_patient(db: Session, patient: schemas.PatientCreate):
-    db_patient = database.Patient(**patient.dict())
+    db_patient = database.Patient(**patient.dict(), counters=_new_counters())
     db.add(db_patient)
+    _load_for_response(db, db_patient)
     db.commit()
-    db.refresh(db_patient)
+    events.publish("patients")
     return db_patient
 
 def update_patient(db: Session, patient_id: int, patient: schemas.PatientUpdate):
@@ -27,8 +58,9 @@ def update_patient(db: Session, patient_id: int, patient: schemas.PatientUpdate)
     if db_patient:
         for key, value in patient.dict().items():
             setattr(db_patient, key, value)
+        _load_for_response(db, db_patient)
         db.commit()
-        db.refresh(db_patient)
+        events.publish("patients")
     return db_patient
 
 def delete_patient(db: Session, patient_id: int):
@@ -36,16 +68,18 @@ def delete_patient(db: Session, patient_id: int):
     if not db_patient:
         return None
     
-    # Check for dependent records
-    appointment_count = db.query(database.Appointment).filter(database.Appointment.patient_id == patient_id).count()
-    payment_count = db.query(database.Payment).filter(database.Payment.patient_id == patient_id).count()
-    visit_count = db.query(database.PatientVisit).filter(database.PatientVisit.patient_id == patient_id).count()
+    # Check for dependent records using the maintained counters
+    counters = db_patient.counters
+    if counters is None:
+        counters = db_patient.counters = _computed_counters(db, patient_id)
     
-    if appointment_count > 0 or payment_count > 0 or visit_count > 0:
-        raise ValueError(f"Cannot delete patient: {appointment_count} appointments, {payment_count} payments, and {visit_count} visits exist")
+    if counters.appointment_count > 0 or counters.payment_count > 0 or counters.visit_count > 0:
+        raise ValueError(f"Cannot delete patient: {counters.appointment_count} appointments, {counters.payment_count} payments, and {counters.visit_count} visits exist")
     
     db.delete(db_patient)
+    _add_tombstone(db, "patients", patient_id)
     db.commit()
+    events.publish("patients")
     return db_patient
 
 # Appointment CRUD operations
@@ -55,6 +89,10 @@ def get_appointment(db: Session, appointment_id: int):
 def get_appointments(db: Session, skip: int = 0, limit: int = 100):
     return db.query(database.Appointment).offset(skip).limit(limit).all()
 
+def stream_appointments(db: Session, skip: int = 0, limit: Optional[int] = None):
+    query = db.query(database.Appointment).options(joinedload(database.Appointment.patient))
+    return stream_rows([query], skip, limit)
+
 def create_appointment(db: Session, appointment: schemas.AppointmentCreate):
     # Verify patient exists
     patient = db.query(database.Patient).filter(database.Patient.id == appointment.patient_id).first()
@@ -63,35 +101,56 @@ def create_appointment(db: Session, appointment: schemas.AppointmentCreate):
     
     db_appointment = database.Appointment(**appointment.dict())
     db.add(db_appointment)
+    _bump_counters(db, db_appointment.patient_id, appointment_count=1)
+    _load_for_response(db, db_appointment)
     db.commit()
-    db.refresh(db_appointment)
+    events.publish("appointments")
     return db_appointment
 
 def update_appointment(db: Session, appointment_id: int, appointment: schemas.AppointmentUpdate):
     db_appointment = db.query(database.Appointment).filter(database.Appointment.id == appointment_id).first()
     if db_appointment:
+        old_patient_id = db_appointment.patient_id
         for key, value in appointment.dict().items():
             setattr(db_appointment, key, value)
+        if db_appointment.patient_id != old_patient_id:
+            _bump_counters(db, old_patient_id, appointment_count=-1)
+            _bump_counters(db, db_appointment.patient_id, appointment_count=1)
+        _load_for_response(db, db_appointment)
         db.commit()
-        db.refresh(db_appointment)
+        events.publish("appointments")
     return db_appointment
 
 def delete_appointment(db: Session, appointment_id: int):
     db_appointment = db.query(database.Appointment).filter(database.Appointment.id == appointment_id).first()
     if db_appointment:
         db.delete(db_appointment)
+        _add_tombstone(db, "appointments", appointment_id)
+        _bump_counters(db, db_appointment.patient_id, appointment_count=-1)
         db.commit()
+        events.publish("appointments")
     return db_appointment
 
 # Payment CRUD operations
 def get_payment(db: Session, payment_id: int):
-    return db.query(database.Payment).filter(database.Payment.id == payment_id).first()
+    for source in _sources(db, database.Payment):
+        db_payment = db.query(source).filter(source.id == payment_id).first()
+        if db_payment:
+            return db_payment
+    return None
 
 def get_payments(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(database.Payment).offset(skip).limit(limit).all()
+    return _page_across([db.query(source) for source in _sources(db, database.Payment)], skip, limit)
+
+def stream_payments(db: Session, skip: int = 0, limit: Optional[int] = None):
+    queries = [db.query(source).options(joinedload(source.patient)) for source in _sources(db, database.Payment)]
+    return stream_rows(queries, skip, limit)
 
 def get_payments_by_patient(db: Session, patient_id: int):
-    return db.query(database.Payment).filter(database.Payment.patient_id == patient_id).all()
+    payments = []
+    for source in _sources(db, database.Payment):
+        payments.extend(db.query(source).filter(source.patient_id == patient_id).all())
+    return payments
 
 def create_payment(db: Session, payment: schemas.PaymentCreate):
     # Verify patient exists
@@ -101,26 +160,308 @@ def create_payment(db: Session, payment: schemas.PaymentCreate):
     
     db_payment = database.Payment(**payment.dict())
     db.add(db_payment)
+    _bump_counters(db, db_payment.patient_id, payment_count=1, payment_total=db_payment.amount)
+    _load_for_response(db, db_payment)
     db.commit()
-    db.refresh(db_payment)
+    events.publish("payments")
     return db_payment
 
 def update_payment(db: Session, payment_id: int, payment: schemas.PaymentUpdate):
     db_payment = db.query(database.Payment).filter(database.Payment.id == payment_id).first()
-    if db_payment:
+    if not db_payment:
+        _ensure_not_archived(db, database.Payment, payment_id, "Payment")
+    else:
+        old_patient_id, old_amount = db_payment.patient_id, db_payment.amount
         for key, value in payment.dict().items():
             setattr(db_payment, key, value)
+        if db_payment.patient_id == old_patient_id:
+            _bump_counters(db, old_patient_id, payment_total=db_payment.amount - old_amount)
+        else:
+            _bump_counters(db, old_patient_id, payment_count=-1, payment_total=-old_amount)
+            _bump_counters(db, db_payment.patient_id, payment_count=1, payment_total=db_payment.amount)
+        _load_for_response(db, db_payment)
         db.commit()
-        db.refresh(db_payment)
+        events.publish("payments")
     return db_payment
 
 def delete_payment(db: Session, payment_id: int):
     db_payment = db.query(database.Payment).filter(database.Payment.id == payment_id).first()
-    if db_payment:
+    if not db_payment:
+        _ensure_not_archived(db, database.Payment, payment_id, "Payment")
+    else:
         db.delete(db_payment)
+        _add_tombstone(db, "payments", payment_id)
+        _bump_counters(db, db_payment.patient_id, payment_count=-1, payment_total=-db_payment.amount)
         db.commit()
+        events.publish("payments")
     return db_payment
 
+# Per-patient counters
+COUNTER_FIELDS = ["visit_count", "appointment_count", "payment_count", "payment_total", "last_visit_date", "next_visit_date"]
+
+def _new_counters():
+    return database.PatientCounters(visit_count=0, appointment_count=0, payment_count=0, payment_total=0.0)
+
+def _load_for_response(db: Session, record):
+    # Write sessions keep objects loaded after commit; read everything the
+    # response shows now, as a later load would begin another writer transaction
+    db.flush()
+    db.refresh(record)
+    patient = record if isinstance(record, database.Patient) else record.patient
+    if patient is not None:
+        db.refresh(patient)
+
+def _bump_counters(db: Session, patient_id: int, **deltas):
+    # Atomic in-database increments, in the same transaction as the write itself
+    counters = database.PatientCounters
+    updated = db.query(counters).filter(counters.patient_id == patient_id).update(
+        {getattr(counters, name): getattr(counters, name) + delta for name, delta in deltas.items()},
+        synchronize_session=False
+    )
+    if not updated:
+        # Patient created before counters existed: compute its row from scratch, change included
+        db.flush()
+        db.add(_computed_counters(db, patient_id))
+        db.flush()
+
+def _latest_visit(db: Session, patient_id: int):
+    for source in _sources(db, database.PatientVisit):
+        latest = db.query(source.visit_date, source.next_visit_date).filter(
+            source.patient_id == patient_id
+        ).order_by(source.visit_date.desc(), source.id.desc()).first()
+        if latest:
+            return latest
+    return None
+
+def _refresh_visit_dates(db: Session, patient_id: int):
+    db.flush()
+    # Lock the counters row before reading: concurrent visit writes for this
+    # patient then take turns, and each one's read sees the visits committed before it
+    counters = database.PatientCounters
+    db.query(counters.patient_id).filter(counters.patient_id == patient_id).with_for_update().first()
+    latest = _latest_visit(db, patient_id)
+    db.query(counters).filter(counters.patient_id == patient_id).update({
+        "last_visit_date": latest.visit_date if latest else None,
+        "next_visit_date": latest.next_visit_date if latest else None
+    }, synchronize_session=False)
+
+def _computed_counters(db: Session, patient_id: int):
+    counters = _new_counters()
+    counters.patient_id = patient_id
+    counters.appointment_count = db.query(database.Appointment).filter(database.Appointment.patient_id == patient_id).count()
+    for source in _sources(db, database.PatientVisit):
+        counters.visit_count += db.query(source).filter(source.patient_id == patient_id).count()
+    for source in _sources(db, database.Payment):
+        count, total = db.query(func.count(source.id), func.sum(source.amount)).filter(source.patient_id == patient_id).one()
+        counters.payment_count += count
+        counters.payment_total += float(total or 0)
+    latest = _latest_visit(db, patient_id)
+    if latest:
+        counters.last_visit_date, counters.next_visit_date = latest.visit_date, latest.next_visit_date
+    return counters
+
+def rebuild_patient_counters(db: Session, fix: bool = True):
+    """Recompute every patient's counters with grouped queries; return the ids that were out of date."""
+    expected = {}
+
+    def entry(patient_id):
+        return expected.setdefault(patient_id, {
+            "visit_count": 0, "appointment_count": 0, "payment_count": 0, "payment_total": 0.0,
+            "last_visit_date": None, "next_visit_date": None
+        })
+
+    for patient_id, in db.query(database.Patient.id):
+        entry(patient_id)
+    for patient_id, count in db.query(database.Appointment.patient_id, func.count(database.Appointment.id)).group_by(database.Appointment.patient_id):
+        entry(patient_id)["appointment_count"] = count
+    for source in _sources(db, database.Payment):
+        for patient_id, count, total in db.query(source.patient_id, func.count(source.id), func.sum(source.amount)).group_by(source.patient_id):
+            entry(patient_id)["payment_count"] += count
+            entry(patient_id)["payment_total"] += float(total or 0)
+    # Archived visits are older, so the live table wins for the latest visit
+    for source in reversed(_sources(db, database.PatientVisit)):
+        for patient_id, count in db.query(source.patient_id, func.count(source.id)).group_by(source.patient_id):
+            entry(patient_id)["visit_count"] += count
+        ranked = db.query(
+            source.patient_id, source.visit_date, source.next_visit_date,
+            func.row_number().over(
+                partition_by=source.patient_id,
+                order_by=(source.visit_date.desc(), source.id.desc())
+            ).label("position")
+        ).subquery()
+        for patient_id, visit_date, next_visit_date, _ in db.query(ranked).filter(ranked.c.position == 1):
+            entry(patient_id)["last_visit_date"] = visit_date
+            entry(patient_id)["next_visit_date"] = next_visit_date
+
+    stored = {counters.patient_id: counters for counters in db.query(database.PatientCounters)}
+    mismatched = []
+    for patient_id, values in expected.items():
+        counters = stored.get(patient_id)
+        current = {name: getattr(counters, name) for name in COUNTER_FIELDS} if counters else None
+        if current is not None and abs(current["payment_total"] - values["payment_total"]) < 0.005:
+            current["payment_total"] = values["payment_total"]
+        if current != values:
+            mismatched.append(patient_id)
+            if fix:
+                if counters is None:
+                    counters = database.PatientCounters(patient_id=patient_id)
+                    db.add(counters)
+                for name, value in values.items():
+                    setattr(counters, name, value)
+    if fix:
+        db.commit()
+    return mismatched
+
+# Delta sync
+SYNC_OVERLAP_SECONDS = int(os.getenv("SYNC_OVERLAP_SECONDS", "30"))
+
+# response key -> (model, tombstone table name)
+SYNC_TABLES = {
+    "patients": (database.Patient, "patients"),
+    "appointments": (database.Appointment, "appointments"),
+    "payments": (database.Payment, "payments"),
+    "visits": (database.PatientVisit, "patient_visits"),
+}
+
+def _add_tombstone(db: Session, table_name: str, row_id: int):
+    db.add(database.Tombstone(table_name=table_name, row_id=row_id))
+
+def _encode_sync_token(cursors):
+    raw = json.dumps({key: [timestamp.isoformat(), row_id] for key, (timestamp, row_id) in cursors.items()})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def _decode_sync_token(token: Optional[str]):
+    if not token:
+        return {}
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        return {key: (datetime.fromisoformat(timestamp), int(row_id)) for key, (timestamp, row_id) in json.loads(raw).items()}
+    except (ValueError, TypeError):
+        raise ValueError("Invalid sync token")
+
+def _changed_since(db: Session, model, timestamp_column, cursor, limit: int):
+    # Keyset scan over (timestamp, id): rows changed after the cursor, oldest first
+    query = db.query(model)
+    if cursor:
+        timestamp, row_id = cursor
+        query = query.filter(or_(
+            timestamp_column > timestamp,
+            and_(timestamp_column == timestamp, model.id > row_id)
+        ))
+    return query.order_by(timestamp_column, model.id).limit(limit + 1).all()
+
+def _next_sync_cursor(rows, timestamp_name: str, cursor, limit: int):
+    if len(rows) > limit:
+        # More to come: continue exactly after the last row returned
+        last = rows[limit - 1]
+        return (getattr(last, timestamp_name), last.id), True
+    if rows:
+        # Caught up. Rows stamped within the last SYNC_OVERLAP_SECONDS may
+        # still be joined by slower transactions committing late, so re-read
+        # that window next time (clients upsert by id); anything older is final
+        last = rows[-1]
+        settled = datetime.utcnow() - timedelta(seconds=SYNC_OVERLAP_SECONDS)
+        last_timestamp = getattr(last, timestamp_name)
+        if last_timestamp <= settled:
+            return (last_timestamp, last.id), False
+        return (settled, 0), False
+    return cursor, False
+
+def get_changes(db: Session, since: Optional[str] = None, limit: int = 500):
+    """Rows created, updated or deleted since the token, at most limit per table."""
+    cursors = _decode_sync_token(since)
+    next_cursors = {}
+    changes = {"has_more": False, "deleted": {}}
+
+    for key, (model, table_name) in SYNC_TABLES.items():
+        rows = _changed_since(db, model, model.updated_at, cursors.get(key), limit)
+        next_cursors[key], has_more = _next_sync_cursor(rows, "updated_at", cursors.get(key), limit)
+        changes[key] = rows[:limit]
+        changes["has_more"] = changes["has_more"] or has_more
+
+    tombstones = _changed_since(db, database.Tombstone, database.Tombstone.deleted_at, cursors.get("deleted"), limit)
+    next_cursors["deleted"], has_more = _next_sync_cursor(tombstones, "deleted_at", cursors.get("deleted"), limit)
+    changes["has_more"] = changes["has_more"] or has_more
+    for key, (_, table_name) in SYNC_TABLES.items():
+        changes["deleted"][key] = [tombstone.row_id for tombstone in tombstones[:limit] if tombstone.table_name == table_name]
+
+    changes["token"] = _encode_sync_token({key: cursor for key, cursor in next_cursors.items() if cursor})
+    return changes
+
+# Archive-aware reads
+_archive_state_cache = {}
+
+def _archived_before(db: Session, model):
+    # Cut-off date below which rows of model live in its archive table, cached briefly per database
+    if model not in database.ARCHIVES:
+        return None
+    key = str(db.get_bind().url)
+    cached = _archive_state_cache.get(key)
+    if cached is None or (datetime.utcnow() - cached[0]).total_seconds() > partitioning.ARCHIVE_STATE_TTL:
+        states = {state.table_name: state.archived_before for state in db.query(database.ArchiveState).all()}
+        cached = (datetime.utcnow(), states)
+        _archive_state_cache[key] = cached
+    return cached[1].get(model.__tablename__)
+
+def _ensure_not_archived(db: Session, model, record_id: int, label: str):
+    # Called when record_id is not in the live table; archived rows are never changed in place
+    archive_model = database.ARCHIVES[model][0]
+    if db.query(archive_model.id).filter(archive_model.id == record_id).first():
+        raise ValueError(f"{label} {record_id} is archived; archived records are read-only")
+
+def _sources(db: Session, model, start_date=None):
+    # The live model, plus its archive only when the requested range starts before the cut-off
+    archived_before = _archived_before(db, model)
+    if archived_before is not None and (start_date is None or _as_date(start_date) < archived_before):
+        return [model, database.ARCHIVES[model][0]]
+    return [model]
+
+def _page_across(queries, skip: int, limit: int):
+    # Offset/limit over live rows followed by archived rows; later queries only run when the page reaches them
+    results = []
+    for index, query in enumerate(queries):
+        if len(results) >= limit:
+            break
+        if skip and index < len(queries) - 1:
+            total = query.count()
+            if skip >= total:
+                skip -= total
+                continue
+        results.extend(query.offset(skip).limit(limit - len(results)).all())
+        skip = 0
+    return results
+
+# Streaming reads
+STREAM_BATCH_SIZE = 1000
+
+def stream_rows(queries, skip: int = 0, limit: Optional[int] = None, batch_size: int = STREAM_BATCH_SIZE):
+    """Yield rows one at a time from each query in turn, batch_size rows in memory at once.
+
+    Rows come from a server-side cursor where the driver supports one, so the
+    full result set is never materialized. skip and limit become OFFSET and
+    LIMIT; an earlier query is only counted, like in _page_across, when the
+    skip might pass over all of it. The queries are built by the caller, so
+    invalid arguments fail before the first row is sent.
+    """
+    remaining = limit
+    for index, query in enumerate(queries):
+        if remaining is not None and remaining <= 0:
+            return
+        if skip and index < len(queries) - 1:
+            total = query.count()
+            if skip >= total:
+                skip -= total
+                continue
+        if skip:
+            query = query.offset(skip)
+            skip = 0
+        if remaining is not None:
+            query = query.limit(remaining)
+        for row in query.yield_per(batch_size):
+            if remaining is not None:
+                remaining -= 1
+            yield row
+
 # Analytics functions
 def get_patient_stats(db: Session, start_date: Optional[date] = None, end_date: Optional[date] = None):
     # Set default to current month if no dates provided
@@ -143,21 +484,28 @@ def get_patient_stats(db: Session, start_date: Optional[date] = None, end_date:
     avg_patients_per_day = recent_patients / 30.0
     
     # Get patient distribution based on visit types within date range
-    new_patients = db.query(database.PatientVisit).filter(
-        and_(
-            database.PatientVisit.visit_type == "new",
-            database.PatientVisit.visit_date >= start_date,
-            database.PatientVisit.visit_date <= end_date
-        )
-    ).count()
-    
-    followup_patients = db.query(database.PatientVisit).filter(
-        and_(
-            database.PatientVisit.visit_type == "follow-up", 
-            database.PatientVisit.visit_date >= start_date,
-            database.PatientVisit.visit_date <= end_date
-        )
-    ).count()
+    visit_sources = _sources(db, database.PatientVisit, start_date)
+    new_patients = sum(
+        db.query(source).filter(
+            and_(
+                source.visit_type == "new",
+                source.visit_date >= start_date,
+                source.visit_date <= end_date
+            )
+        ).count()
+        for source in visit_sources
+    )
+    
+    followup_patients = sum(
+        db.query(source).filter(
+            and_(
+                source.visit_type == "follow-up", 
+                source.visit_date >= start_date,
+                source.visit_date <= end_date
+            )
+        ).count()
+        for source in visit_sources
+    )
     
     return {
         "total_patients": total_patients,
@@ -174,7 +522,7 @@ def get_appointment_stats(db: Session):
     today = datetime.utcnow().date()
     
     daily_appointments = db.query(database.Appointment).filter(
-        func.date(database.Appointment.appointment_date) == today
+        *_date_range_filter(database.Appointment.appointment_date, today, today)
     ).count()
     
     upcoming_appointments = db.query(database.Appointment).filter(
@@ -185,16 +533,11 @@ def get_appointment_stats(db: Session):
     ).count()
     
     # Get daily appointment counts for the next 14 days (including today)
-    appointment_counts = []
-    for i in range(14):
-        date = today + timedelta(days=i)
-        count = db.query(database.Appointment).filter(
-            func.date(database.Appointment.appointment_date) == date
-        ).count()
-        appointment_counts.append({
-            "date": date.strftime("%Y-%m-%d"),
-            "count": count
-        })
+    upcoming = get_timeseries(db, "appointments", "day", today, today + timedelta(days=13))
+    appointment_counts = [
+        {"date": point["date"], "count": point["value"]}
+        for point in upcoming["series"][0]["points"]
+    ]
     
     return {
         "daily_appointments": daily_appointments,
@@ -204,37 +547,32 @@ def get_appointment_stats(db: Session):
 
 def get_finance_stats(db: Session):
     today = datetime.utcnow().date()
-    current_month = datetime.utcnow().month
-    current_year = datetime.utcnow().year
+    month_start = today.replace(day=1)
     
     # Daily revenue
     daily_revenue = db.query(func.sum(database.Payment.amount)).filter(
-        func.date(database.Payment.payment_date) == today
+        *_date_range_filter(database.Payment.payment_date, today, today)
     ).scalar() or 0
     
     # Monthly revenue
     monthly_revenue = db.query(func.sum(database.Payment.amount)).filter(
-        and_(
-            extract('month', database.Payment.payment_date) == current_month,
-            extract('year', database.Payment.payment_date) == current_year
-        )
+        *_date_range_filter(database.Payment.payment_date, month_start, _next_bucket(month_start, "month") - timedelta(days=1))
     ).scalar() or 0
     
-    # Payment mode breakdown
-    payment_mode_breakdown = db.query(
-        database.Payment.payment_mode,
-        func.sum(database.Payment.amount).label("total"),
-        func.count(database.Payment.id).label("count")
-    ).group_by(database.Payment.payment_mode).all()
-    
-    payment_breakdown = [
-        {
-            "mode": item.payment_mode,
-            "total": float(item.total),
-            "count": item.count
-        }
-        for item in payment_mode_breakdown
-    ]
+    # Payment mode breakdown (all time, so archived payments are included)
+    breakdown = {}
+    for source in _sources(db, database.Payment):
+        payment_mode_breakdown = db.query(
+            source.payment_mode,
+            func.sum(source.amount).label("total"),
+            func.count(source.id).label("count")
+        ).group_by(source.payment_mode).all()
+        for item in payment_mode_breakdown:
+            totals = breakdown.setdefault(item.payment_mode, {"mode": item.payment_mode, "total": 0.0, "count": 0})
+            totals["total"] += float(item.total)
+            totals["count"] += item.count
+    
+    payment_breakdown = list(breakdown.values())
     
     return {
         "daily_revenue": float(daily_revenue),
@@ -242,42 +580,254 @@ def get_finance_stats(db: Session):
         "payment_mode_breakdown": payment_breakdown
     }
 
-def export_patients_csv(db: Session):
-    patients = db.query(database.Patient).all()
-    data = []
-    for patient in patients:
-        data.append({
-            "id": patient.id,
-            "name": patient.name,
-            "age": patient.age,
-            "gender": patient.gender,
-            "mobile": patient.mobile,
-            "address": patient.address,
-            "referral": patient.referral,
-            "history": patient.history,
-            "created_at": patient.created_at
-        })
-    
-    df = pd.DataFrame(data)
-    return df
+# Time-series analytics
+TIMESERIES_GRANULARITIES = ("day", "week", "month")
+MAX_TIMESERIES_BUCKETS = 5000
+
+# metric -> (model, date column, summed column or None for a row count, group_by options)
+TIMESERIES_METRICS = {
+    "revenue": (database.Payment, "payment_date", "amount", {"payment_mode": "payment_mode"}),
+    "visits": (database.PatientVisit, "visit_date", None, {"doctor": "doctor_name", "visit_type": "visit_type"}),
+    "appointments": (database.Appointment, "appointment_date", None, {"doctor": "doctor_name"}),
+    "new_patients": (database.Patient, "created_at", None, {}),
+}
+
+def _date_bucket(db: Session, column, granularity: str):
+    # Truncate a date/datetime column to the start of its day, week (Monday) or month
+    if db.get_bind().dialect.name == "postgresql":
+        return func.date_trunc(granularity, column)
+    if granularity == "week":
+        return func.date(column, "weekday 0", "-6 days")
+    if granularity == "month":
+        return func.strftime("%Y-%m-01", column)
+    return func.date(column)
+
+def _bucket_start(day: date, granularity: str):
+    if granularity == "week":
+        return day - timedelta(days=day.weekday())
+    if granularity == "month":
+        return day.replace(day=1)
+    return day
+
+def _next_bucket(day: date, granularity: str):
+    if granularity == "week":
+        return day + timedelta(days=7)
+    if granularity == "month":
+        return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return day + timedelta(days=1)
+
+def _as_date(value):
+    # Bucket values come back as datetimes on Postgres and ISO strings on SQLite
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+def _buckets(start_date: date, end_date: date, granularity: str):
+    buckets = []
+    bucket = _bucket_start(start_date, granularity)
+    while bucket <= end_date:
+        buckets.append(bucket)
+        if len(buckets) > MAX_TIMESERIES_BUCKETS:
+            raise ValueError(f"Range too large: more than {MAX_TIMESERIES_BUCKETS} {granularity} buckets requested")
+        bucket = _next_bucket(bucket, granularity)
+    return buckets
+
+def _date_range_filter(column, start_date: date, end_date: date):
+    # Inclusive date range that still uses an index on datetime columns
+    if isinstance(column.type, DateTime):
+        return [
+            column >= datetime.combine(start_date, time.min),
+            column < datetime.combine(end_date + timedelta(days=1), time.min)
+        ]
+    return [column >= start_date, column <= end_date]
+
+def get_timeseries(db: Session, metric: str, granularity: str = "day", start_date: Optional[date] = None, end_date: Optional[date] = None, group_by: Optional[str] = None):
+    if metric not in TIMESERIES_METRICS:
+        raise ValueError(f"Unknown metric '{metric}', expected one of: {', '.join(TIMESERIES_METRICS)}")
+    if granularity not in TIMESERIES_GRANULARITIES:
+        raise ValueError(f"Unknown granularity '{granularity}', expected one of: {', '.join(TIMESERIES_GRANULARITIES)}")
+
+    model, date_name, amount_name, group_options = TIMESERIES_METRICS[metric]
+    if group_by and group_by not in group_options:
+        raise ValueError(f"Metric '{metric}' cannot be grouped by '{group_by}'")
+
+    # Default to the last 30 days
+    if end_date is None:
+        end_date = datetime.utcnow().date()
+    if start_date is None:
+        start_date = end_date - timedelta(days=29)
+    if start_date > end_date:
+        raise ValueError("'from' must not be after 'to'")
+
+    buckets = _buckets(start_date, end_date, granularity)
+
+    # One grouped query for the whole range (per table when archived rows are needed)
+    totals = {} if group_by else {None: {}}
+    for source in _sources(db, model, start_date):
+        date_column = getattr(source, date_name)
+        columns = [_date_bucket(db, date_column, granularity).label("bucket")]
+        if group_by:
+            columns.append(getattr(source, group_options[group_by]).label("group"))
+        value = func.sum(getattr(source, amount_name)) if amount_name else func.count(source.id)
+
+        rows = db.query(*columns, value.label("value")).filter(
+            *_date_range_filter(date_column, start_date, end_date)
+        ).group_by(*columns).all()
+
+        for row in rows:
+            key = row.group if group_by else None
+            bucket_values = totals.setdefault(key, {})
+            bucket = _as_date(row.bucket)
+            bucket_values[bucket] = bucket_values.get(bucket, 0) + (row.value or 0)
+
+    # Fill gaps with zeros so every series has one point per bucket
+    cast = float if amount_name else int
+    series = [
+        {
+            "group": key,
+            "points": [
+                {"date": bucket.isoformat(), "value": cast(values.get(bucket) or 0)}
+                for bucket in buckets
+            ]
+        }
+        for key, values in sorted(totals.items(), key=lambda item: str(item[0]))
+    ]
+
+    return {
+        "metric": metric,
+        "granularity": granularity,
+        "start_date": start_date,
+        "end_date": end_date,
+        "group_by": group_by,
+        "series": series
+    }
+
+# Prescription and diagnosis analytics over the normalized visit_terms index
+def get_term_stats(db: Session, field: str, start_date: Optional[date] = None, end_date: Optional[date] = None, doctor: Optional[str] = None, limit: int = 20, granularity: Optional[str] = None, selected_terms: Optional[List[str]] = None):
+    if field not in terms.TERM_FIELDS:
+        raise ValueError(f"Unknown field '{field}', expected one of: {', '.join(terms.TERM_FIELDS)}")
+    if granularity and granularity not in TIMESERIES_GRANULARITIES:
+        raise ValueError(f"Unknown granularity '{granularity}', expected one of: {', '.join(TIMESERIES_GRANULARITIES)}")
+
+    # Default to the last 30 days
+    if end_date is None:
+        end_date = datetime.utcnow().date()
+    if start_date is None:
+        start_date = end_date - timedelta(days=29)
+    if start_date > end_date:
+        raise ValueError("'from' must not be after 'to'")
+
+    VisitTerm = database.VisitTerm
+    filters = [VisitTerm.field == field, *_date_range_filter(VisitTerm.visit_date, start_date, end_date)]
+    if doctor:
+        filters.append(func.lower(VisitTerm.doctor_name) == doctor.lower())
+
+    # Top terms in the period: one grouped scan of the (field, visit_date) index
+    visits = func.count(VisitTerm.visit_id)
+    top = db.query(
+        VisitTerm.term,
+        visits.label("visits"),
+        func.count(func.distinct(VisitTerm.patient_id)).label("patients")
+    ).filter(*filters).group_by(VisitTerm.term).order_by(visits.desc(), VisitTerm.term).limit(limit).all()
+    items = [{"term": row.term, "visits": row.visits, "patients": row.patients} for row in top]
+
+    series = None
+    if granularity:
+        # Trend per term: the requested terms, or else the top ones
+        trend_terms = []
+        for selected in selected_terms or []:
+            trend_terms.extend(term for term in terms.normalize_terms(field, selected) if term not in trend_terms)
+        trend_terms = trend_terms or [item["term"] for item in items]
+        buckets = _buckets(start_date, end_date, granularity)
+        totals = {term: {} for term in trend_terms}
+        if trend_terms:
+            bucket = _date_bucket(db, VisitTerm.visit_date, granularity).label("bucket")
+            rows = db.query(VisitTerm.term, bucket, func.count(VisitTerm.visit_id).label("value")).filter(
+                *filters, VisitTerm.term.in_(trend_terms)
+            ).group_by(VisitTerm.term, bucket).all()
+            for row in rows:
+                totals[row.term][_as_date(row.bucket)] = row.value
+        series = [
+            {
+                "group": term,
+                "points": [
+                    {"date": day.isoformat(), "value": totals[term].get(day, 0)}
+                    for day in buckets
+                ]
+            }
+            for term in trend_terms
+        ]
+
+    return {
+        "field": field,
+        "start_date": start_date,
+        "end_date": end_date,
+        "doctor": doctor,
+        "granularity": granularity,
+        "items": items,
+        "series": series
+    }
+
+PATIENT_EXPORT_COLUMNS = ["id", "name", "age", "gender", "mobile", "address", "referral", "history", "created_at"]
+
+def export_patients_csv_file(db: Session, path: str, progress=None, batch_size: int = 1000):
+    # Write patients to disk in id-ordered batches, each read in its own short
+    # transaction, instead of building a DataFrame of the whole table in memory
+    exported_count = 0
+    last_id = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(PATIENT_EXPORT_COLUMNS)
+        while True:
+            batch = db.query(*[getattr(database.Patient, column) for column in PATIENT_EXPORT_COLUMNS]).filter(
+                database.Patient.id > last_id
+            ).order_by(database.Patient.id).limit(batch_size).all()
+            db.rollback()
+            if not batch:
+                break
+            writer.writerows(batch)
+            exported_count += len(batch)
+            last_id = batch[-1].id
+            if progress:
+                progress(exported_count)
+    
+    return exported_count
 
 # Patient Visit CRUD operations
 def get_visit(db: Session, visit_id: int):
-    return db.query(database.PatientVisit).filter(database.PatientVisit.id == visit_id).first()
+    for source in _sources(db, database.PatientVisit):
+        db_visit = db.query(source).filter(source.id == visit_id).first()
+        if db_visit:
+            return db_visit
+    return None
 
-def get_visits(db: Session, skip: int = 0, limit: int = 100, patient_id: Optional[int] = None, start_date: Optional[str] = None, end_date: Optional[str] = None):
-    query = db.query(database.PatientVisit)
-    
-    if patient_id:
-        query = query.filter(database.PatientVisit.patient_id == patient_id)
-    
-    if start_date:
-        query = query.filter(database.PatientVisit.visit_date >= start_date)
-    
-    if end_date:
-        query = query.filter(database.PatientVisit.visit_date <= end_date)
-    
-    return query.order_by(database.PatientVisit.visit_date.desc()).offset(skip).limit(limit).all()
+def get_visits(db: Session, skip: int = 0, limit: int = 100, patient_id: Optional[int] = None, start_date: Optional[date] = None, end_date: Optional[date] = None):
+    # Archived visits are all older than live ones, so they simply follow
+    return _page_across(_visit_queries(db, patient_id, start_date, end_date), skip, limit)
+
+def stream_visits(db: Session, skip: int = 0, limit: Optional[int] = None, patient_id: Optional[int] = None, start_date: Optional[date] = None, end_date: Optional[date] = None):
+    return stream_rows(_visit_queries(db, patient_id, start_date, end_date, load_patient=True), skip, limit)
+
+def _visit_queries(db: Session, patient_id: Optional[int] = None, start_date: Optional[date] = None, end_date: Optional[date] = None, load_patient: bool = False):
+    queries = []
+    for source in _sources(db, database.PatientVisit, start_date):
+        query = db.query(source)
+        if load_patient:
+            query = query.options(joinedload(source.patient))
+        
+        if patient_id:
+            query = query.filter(source.patient_id == patient_id)
+        
+        if start_date:
+            query = query.filter(source.visit_date >= start_date)
+        
+        if end_date:
+            query = query.filter(source.visit_date <= end_date)
+        
+        queries.append(query.order_by(source.visit_date.desc()))
+    return queries
 
 def create_visit(db: Session, visit: schemas.PatientVisitCreate):
     # Verify patient exists
@@ -287,59 +837,95 @@ def create_visit(db: Session, visit: schemas.PatientVisitCreate):
     
     db_visit = database.PatientVisit(**visit.dict())
     db.add(db_visit)
+    _bump_counters(db, db_visit.patient_id, visit_count=1)
+    _refresh_visit_dates(db, db_visit.patient_id)
+    search.index_visit(db, db_visit)
+    terms.index_visit(db, db_visit)
+    _load_for_response(db, db_visit)
     db.commit()
-    db.refresh(db_visit)
+    events.publish("visits")
     return db_visit
 
 def update_visit(db: Session, visit_id: int, visit: schemas.PatientVisitUpdate):
     db_visit = db.query(database.PatientVisit).filter(database.PatientVisit.id == visit_id).first()
-    if db_visit:
+    if not db_visit:
+        _ensure_not_archived(db, database.PatientVisit, visit_id, "Visit")
+    else:
+        old_patient_id = db_visit.patient_id
         for key, value in visit.dict().items():
             setattr(db_visit, key, value)
+        if db_visit.patient_id != old_patient_id:
+            _bump_counters(db, old_patient_id, visit_count=-1)
+            _bump_counters(db, db_visit.patient_id, visit_count=1)
+            _refresh_visit_dates(db, old_patient_id)
+        _refresh_visit_dates(db, db_visit.patient_id)
+        search.index_visit(db, db_visit)
+        terms.index_visit(db, db_visit)
+        _load_for_response(db, db_visit)
         db.commit()
-        db.refresh(db_visit)
+        events.publish("visits")
     return db_visit
 
 def delete_visit(db: Session, visit_id: int):
     db_visit = db.query(database.PatientVisit).filter(database.PatientVisit.id == visit_id).first()
-    if db_visit:
+    if not db_visit:
+        _ensure_not_archived(db, database.PatientVisit, visit_id, "Visit")
+    else:
         db.delete(db_visit)
+        _add_tombstone(db, "patient_visits", visit_id)
+        _bump_counters(db, db_visit.patient_id, visit_count=-1)
+        _refresh_visit_dates(db, db_visit.patient_id)
+        search.remove_visit(db, db_visit.id)
+        terms.remove_visit(db, db_visit.id)
         db.commit()
+        events.publish("visits")
     return db_visit
 
 def get_visit_stats(db: Session):
-    # Total visits
-    total_visits = db.query(database.PatientVisit).count()
+    # Totals per visit type and the first visit date, across live and archived visits
+    total_visits = 0
+    type_counts = {}
+    first_visit_date = None
+    for source in _sources(db, database.PatientVisit):
+        rows = db.query(
+            source.visit_type,
+            func.count(source.id).label('count'),
+            func.min(source.visit_date).label('first_visit_date')
+        ).group_by(source.visit_type).all()
+        for row in rows:
+            total_visits += row.count
+            type_counts[row.visit_type] = type_counts.get(row.visit_type, 0) + row.count
+            visit_date = _as_date(row.first_visit_date)
+            if first_visit_date is None or visit_date < first_visit_date:
+                first_visit_date = visit_date
     
     # New vs follow-up
-    new_visits = db.query(database.PatientVisit).filter(database.PatientVisit.visit_type == 'new').count()
-    followup_visits = db.query(database.PatientVisit).filter(database.PatientVisit.visit_type == 'follow-up').count()
+    new_visits = type_counts.get('new', 0)
+    followup_visits = type_counts.get('follow-up', 0)
     
     # Daily visits (last 30 days)
-    thirty_days_ago = datetime.now() - timedelta(days=30)
-    daily_visits = db.query(
-        database.PatientVisit.visit_date,
-        func.count(database.PatientVisit.id).label('count')
-    ).filter(
-        database.PatientVisit.visit_date >= thirty_days_ago.date()
-    ).group_by(
-        database.PatientVisit.visit_date
-    ).order_by(
-        database.PatientVisit.visit_date
-    ).all()
+    thirty_days_ago = (datetime.now() - timedelta(days=30)).date()
+    daily_counts = {}
+    for source in _sources(db, database.PatientVisit, thirty_days_ago):
+        daily_visits = db.query(
+            source.visit_date,
+            func.count(source.id).label('count')
+        ).filter(
+            source.visit_date >= thirty_days_ago
+        ).group_by(
+            source.visit_date
+        ).all()
+        for visit in daily_visits:
+            daily_counts[visit.visit_date] = daily_counts.get(visit.visit_date, 0) + visit.count
     
     # Average visits per day
-    if total_visits > 0:
-        first_visit = db.query(database.PatientVisit).order_by(database.PatientVisit.visit_date).first()
-        if first_visit:
-            days_since_first = (datetime.now().date() - first_visit.visit_date).days + 1
-            avg_visits_per_day = total_visits / days_since_first
-        else:
-            avg_visits_per_day = 0.0
+    if total_visits > 0 and first_visit_date:
+        days_since_first = (datetime.now().date() - first_visit_date).days + 1
+        avg_visits_per_day = total_visits / days_since_first
     else:
         avg_visits_per_day = 0.0
     
-    visit_counts = [{"date": str(visit.visit_date), "count": visit.count} for visit in daily_visits]
+    visit_counts = [{"date": str(visit_date), "count": count} for visit_date, count in sorted(daily_counts.items())]
     
     return {
         "total_visits": total_visits,
@@ -349,24 +935,70 @@ def get_visit_stats(db: Session):
         "visit_counts": visit_counts
     }
 
-def import_patients_csv(db: Session, csv_data: str):
-    from io import StringIO
-    df = pd.read_csv(StringIO(csv_data))
+# Dashboard sections and the write topics that invalidate them
+DASHBOARD_SECTIONS = {
+    "patient_stats": get_patient_stats,
+    "appointment_stats": get_appointment_stats,
+    "finance_stats": get_finance_stats,
+    "visit_stats": get_visit_stats,
+}
+
+DASHBOARD_TOPICS = {
+    "patients": ["patient_stats"],
+    "visits": ["patient_stats", "visit_stats"],
+    "appointments": ["appointment_stats"],
+    "payments": ["finance_stats"],
+}
+
+def get_dashboard_stats(db: Session, start_date: Optional[date] = None, end_date: Optional[date] = None, sections: Optional[List[str]] = None):
+    stats = {}
+    for name in sections or DASHBOARD_SECTIONS:
+        if name == "patient_stats":
+            stats[name] = get_patient_stats(db, start_date, end_date)
+        else:
+            stats[name] = DASHBOARD_SECTIONS[name](db)
+    return stats
+
+PATIENT_IMPORT_REQUIRED_COLUMNS = ["name", "age", "gender", "mobile"]
+
+def _patient_from_csv_row(row):
+    return schemas.PatientCreate(
+        name=row["name"],
+        age=int(row["age"]),
+        gender=row["gender"],
+        mobile=row["mobile"],
+        address=row.get("address", ""),
+        referral=row.get("referral", ""),
+        history=row.get("history", "")
+    )
+
+def _check_import_columns(df):
+    missing = [column for column in PATIENT_IMPORT_REQUIRED_COLUMNS if column not in df.columns]
+    if missing:
+        raise ValueError(f"Missing required columns: {', '.join(missing)}")
+
+def import_patients_csv_file(db: Session, path: str, progress=None, chunk_size: int = 500):
+    # Import in chunks with one commit per chunk; invalid rows are skipped and reported
     imported_count = 0
-    
-    for _, row in df.iterrows():
-        patient_data = {
-            "name": row["name"],
-            "age": int(row["age"]),
-            "gender": row["gender"],
-            "mobile": row["mobile"],
-            "address": row.get("address", ""),
-            "referral": row.get("referral", ""),
-            "history": row.get("history", "")
-        }
+    failed_count = 0
+    errors = []
+    
+    for chunk in pd.read_csv(path, chunksize=chunk_size, dtype=str, keep_default_na=False):
+        _check_import_columns(chunk)
+        patients = []
+        for index, row in chunk.iterrows():
+            try:
+                patients.append(database.Patient(**_patient_from_csv_row(row).dict(), counters=_new_counters()))
+            except ValueError as e:
+                failed_count += 1
+                if len(errors) < 10:
+                    errors.append(f"Row {index + 2}: {e}")
         
-        patient = schemas.PatientCreate(**patient_data)
-        create_patient(db, patient)
-        imported_count += 1
+        db.add_all(patients)
+        db.commit()
+        events.publish("patients")
+        imported_count += len(patients)
+        if progress:
+            progress(imported_count, failed_count)
     
-    return imported_count
\ No newline at end of file
+    return {"imported": imported_count, "failed": failed_count, "errors": errors}
@@ -1,21 +1,86 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float, ForeignKey, Text, Date
+from sqlalchemy import create_engine, event, inspect, text, Column, Integer, String, DateTime, Float, ForeignKey, Text, Date, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship
+from contextlib import contextmanager
 from datetime import datetime
 import os
+import threading
 from dotenv import load_dotenv
 
 load_dotenv()
 
-DATABASE_URL = os.getenv("DATABASE_URL")
-if not DATABASE_URL:
-    raise ValueError("DATABASE_URL environment variable is required")
+# Without DATABASE_URL the backend runs on a local SQLite file next to the code
+DEFAULT_SQLITE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clinic.db")
+DATABASE_URL = os.getenv("DATABASE_URL") or f"sqlite:///{DEFAULT_SQLITE_PATH}"
 
-engine = create_engine(DATABASE_URL)
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "10000"))
+
+
+def make_engine(url: str):
+    if not url.startswith("sqlite"):
+        return create_engine(url)
+
+    # Sessions may be used from several threads (streamed responses, jobs)
+    engine = create_engine(url, connect_args={"check_same_thread": False})
+    # One writer at a time per process. SQLite allows a single writer anyway;
+    # queueing here instead of inside SQLite avoids "database is locked"
+    writer_lock = threading.Lock()
+
+    @event.listens_for(engine, "connect")
+    def _configure_sqlite(dbapi_connection, connection_record):
+        # Let SQLAlchemy's begin event below emit BEGIN instead of the driver
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        # WAL lets readers run while a write is in progress
+        cursor.execute("PRAGMA journal_mode = WAL")
+        # Durable at each checkpoint rather than each commit; safe with WAL
+        cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}")
+        cursor.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute("PRAGMA temp_store = MEMORY")
+        cursor.execute("PRAGMA foreign_keys = ON")
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def _begin(conn):
+        if not conn.get_execution_options().get("writer"):
+            conn.exec_driver_sql("BEGIN")
+            return
+        # Take the write lock up front, so a transaction never has to upgrade
+        # from reading to writing while another connection is writing
+        writer_lock.acquire()
+        try:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        except Exception:
+            writer_lock.release()
+            raise
+        conn.info["holds_writer_lock"] = True
+
+    @event.listens_for(engine, "commit")
+    @event.listens_for(engine, "rollback")
+    def _end(conn):
+        if conn.info.pop("holds_writer_lock", False):
+            writer_lock.release()
+
+    return engine
+
+
+engine = make_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Sessions for code paths that write; on SQLite their transactions queue for the writer lock.
+# Objects are not expired on commit, so reading them afterwards does not queue again
+WriteSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine.execution_options(writer=True))
 Base = declarative_base()
 
 
+def _counter(name, default):
+    # Read-through to the patient's maintained counters row
+    return property(lambda self: getattr(self.counters, name) if self.counters else default)
+
+
 # Database Models
 class Patient(Base):
     __tablename__ = "patients"
@@ -28,23 +93,50 @@ class Patient(Base):
     address = Column(Text, nullable=True)
     referral = Column(String(100), nullable=True)
     history = Column(Text, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     # Relationships
     appointments = relationship("Appointment", back_populates="patient")
     payments = relationship("Payment", back_populates="patient")
     visits = relationship("PatientVisit", back_populates="patient")
+    counters = relationship("PatientCounters", back_populates="patient", uselist=False,
+                            lazy="joined", cascade="all, delete-orphan")
+
+    visit_count = _counter("visit_count", 0)
+    appointment_count = _counter("appointment_count", 0)
+    payment_count = _counter("payment_count", 0)
+    payment_total = _counter("payment_total", 0.0)
+    last_visit_date = _counter("last_visit_date", None)
+    next_visit_date = _counter("next_visit_date", None)
+
+
+class PatientCounters(Base):
+    __tablename__ = "patient_counters"
+
+    # Aggregates over a patient's appointments, payments and visits (archived
+    # ones included), kept up to date by the crud.py write paths
+    patient_id = Column(Integer, ForeignKey("patients.id"), primary_key=True)
+    visit_count = Column(Integer, nullable=False, default=0, index=True)
+    appointment_count = Column(Integer, nullable=False, default=0, index=True)
+    payment_count = Column(Integer, nullable=False, default=0)
+    payment_total = Column(Float, nullable=False, default=0.0, index=True)
+    last_visit_date = Column(Date, nullable=True, index=True)  # visit_date of the latest visit
+    next_visit_date = Column(Date, nullable=True, index=True)  # next_visit_date of the latest visit
+
+    patient = relationship("Patient", back_populates="counters")
 
 
 class Appointment(Base):
     __tablename__ = "appointments"
 
     id = Column(Integer, primary_key=True, index=True)
-    patient_id = Column(Integer, ForeignKey("patients.id"), nullable=False)
+    patient_id = Column(Integer, ForeignKey("patients.id"), nullable=False, index=True)
     doctor_name = Column(String(100), nullable=False)
-    appointment_date = Column(DateTime, nullable=False)
+    appointment_date = Column(DateTime, nullable=False, index=True)
     status = Column(String(20), nullable=False,
                     default="scheduled")  # scheduled/completed/cancelled
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     # Relationships
     patient = relationship("Patient", back_populates="appointments")
@@ -54,22 +146,26 @@ class Payment(Base):
     __tablename__ = "payments"
 
     id = Column(Integer, primary_key=True, index=True)
-    patient_id = Column(Integer, ForeignKey("patients.id"), nullable=False)
+    patient_id = Column(Integer, ForeignKey("patients.id"), nullable=False, index=True)
     amount = Column(Float, nullable=False)
-    payment_date = Column(DateTime, default=datetime.utcnow)
+    payment_date = Column(DateTime, default=datetime.utcnow, index=True)
     payment_mode = Column(String(20), nullable=False)  # cash/upi/card
     notes = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     # Relationships
     patient = relationship("Patient", back_populates="payments")
 
+    # Never hand out an id again once its row has moved to the archive
+    __table_args__ = {"sqlite_autoincrement": True}
+
 
 class PatientVisit(Base):
     __tablename__ = "patient_visits"
 
     id = Column(Integer, primary_key=True, index=True)
-    patient_id = Column(Integer, ForeignKey("patients.id"), nullable=False)
-    visit_date = Column(Date, nullable=False)
+    patient_id = Column(Integer, ForeignKey("patients.id"), nullable=False, index=True)
+    visit_date = Column(Date, nullable=False, index=True)
     visit_type = Column(String(20), nullable=False)  # new/follow-up
     doctor_name = Column(Text, nullable=True)
     notes = Column(Text, nullable=True)
@@ -82,10 +178,108 @@ class PatientVisit(Base):
     tests = Column(Text, nullable=True)
     
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     # Relationships
     patient = relationship("Patient", back_populates="visits")
 
+    # Never hand out an id again once its row has moved to the archive
+    __table_args__ = {"sqlite_autoincrement": True}
+
+
+# Archive tables: same columns as the live tables, holding rows older than the
+# archive horizon (see partitioning.py). Defined after the live models so they
+# always mirror their current columns.
+def _archive_table(table, name):
+    archive = table.to_metadata(Base.metadata, name=name)
+    # Archived rows keep the ids they were given in the live table
+    archive.c.id.autoincrement = False
+    archive.dialect_options["sqlite"]["autoincrement"] = False
+    return archive
+
+
+class PatientVisitArchive(Base):
+    __table__ = _archive_table(PatientVisit.__table__, "patient_visits_archive")
+
+    patient = relationship("Patient", viewonly=True)
+
+
+class PaymentArchive(Base):
+    __table__ = _archive_table(Payment.__table__, "payments_archive")
+
+    patient = relationship("Patient", viewonly=True)
+
+
+# live model -> (archive model, date column used for the archive horizon)
+ARCHIVES = {
+    PatientVisit: (PatientVisitArchive, "visit_date"),
+    Payment: (PaymentArchive, "payment_date"),
+}
+
+
+class VisitTerm(Base):
+    __tablename__ = "visit_terms"
+
+    # Normalized medicine/diagnosis/test terms per visit, maintained by terms.py.
+    # No foreign key to patient_visits: terms outlive archiving, and a
+    # partitioned patient_visits has no unique id to reference
+    id = Column(Integer, primary_key=True, index=True)
+    visit_id = Column(Integer, nullable=False, index=True)
+    patient_id = Column(Integer, nullable=False)
+    field = Column(String(20), nullable=False)  # medicines/diagnosis/tests
+    term = Column(String(200), nullable=False)
+    visit_date = Column(Date, nullable=False)
+    doctor_name = Column(Text, nullable=True)
+
+    __table_args__ = (
+        # Top-N per period and trends for chosen terms
+        Index("ix_visit_terms_field_visit_date", "field", "visit_date"),
+        Index("ix_visit_terms_field_term_visit_date", "field", "term", "visit_date"),
+    )
+
+
+class ArchiveState(Base):
+    __tablename__ = "archive_state"
+
+    table_name = Column(String(50), primary_key=True)
+    archived_before = Column(Date, nullable=False)  # rows dated before this live in the archive table
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class Tombstone(Base):
+    __tablename__ = "tombstones"
+
+    # One row per deleted record, so offline clients can drop it from their cache
+    id = Column(Integer, primary_key=True, index=True)
+    table_name = Column(String(50), nullable=False)  # patients/appointments/payments/patient_visits
+    row_id = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(String(36), primary_key=True)
+    kind = Column(String(50), nullable=False)  # import_patients/export_patients
+    status = Column(String(20), nullable=False,
+                    default="queued")  # queued/running/completed/failed
+    rows_total = Column(Integer, nullable=True)
+    rows_processed = Column(Integer, nullable=False, default=0)
+    rows_failed = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+    input_path = Column(Text, nullable=True)
+    result_path = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)  # refreshed by the process holding a queued/running job
+
+    @property
+    def download_url(self):
+        if self.status == "completed" and self.result_path:
+            return f"/jobs/{self.id}/download"
+        return None
+
 
 # Database dependency
 def get_db():
@@ -96,6 +290,49 @@ def get_db():
         db.close()
 
 
+def get_write_db():
+    with write_session() as db:
+        yield db
+
+
+@contextmanager
+def write_session():
+    db = WriteSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
 # Create tables
-def create_tables():
-    Base.metadata.create_all(bind=engine)
+def create_tables(bind=None):
+    bind = bind or engine
+    Base.metadata.create_all(bind=bind)
+    _add_missing_columns(bind)
+    _create_missing_indexes(bind)
+
+
+def _add_missing_columns(bind):
+    # create_all() never alters existing tables; add columns introduced since
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=bind.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                if column.name == "updated_at":
+                    # Naive UTC like the ORM default; CURRENT_TIMESTAMP follows the server's time zone
+                    conn.execute(text(f"UPDATE {table.name} SET updated_at = :now"), {"now": datetime.utcnow()})
+
+
+def _create_missing_indexes(bind):
+    # create_all() only creates indexes together with new tables
+    inspector = inspect(bind)
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=bind)
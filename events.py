@@ -0,0 +1,160 @@
+"""
+Change notifications and the shared live dashboard feed.
+
+The crud.py write paths call ``publish(topic)`` after committing. The
+DashboardFeed listens to those topics, waits briefly so a burst of writes
+turns into a single recomputation, recomputes only the dashboard sections
+affected by the changed topics, and pushes the changed sections to every
+connected client. The computation and the encoded message are shared by all
+subscribers, so database load does not grow with the number of open screens.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+DASHBOARD_STREAM_DEBOUNCE = float(os.getenv("DASHBOARD_STREAM_DEBOUNCE", "1.0"))
+# Full refresh interval; also picks up writes made by other worker processes
+DASHBOARD_STREAM_REFRESH = float(os.getenv("DASHBOARD_STREAM_REFRESH", "30"))
+DASHBOARD_STREAM_HEARTBEAT = float(os.getenv("DASHBOARD_STREAM_HEARTBEAT", "15"))
+SUBSCRIBER_QUEUE_SIZE = 16
+
+_listeners = []
+
+
+def subscribe_changes(listener):
+    _listeners.append(listener)
+
+
+def publish(topic: str):
+    # Called from request threads; listeners must be thread-safe
+    for listener in _listeners:
+        listener(topic)
+
+
+def _encode(event: str, data, event_id: int):
+    return f"event: {event}\nid: {event_id}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+class DashboardFeed:
+    def __init__(self, compute, topics):
+        # compute(section_names) -> {section: data}; topics maps topic -> affected sections
+        self._compute = compute
+        self._topics = topics
+        self._sections = sorted({section for sections in topics.values() for section in sections})
+        self._subscribers = set()
+        self._snapshot = None
+        self._snapshot_message = None
+        self._version = 0
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+        self._snapshot_lock = None
+        self._task = None
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def notify(self, topic: str):
+        sections = self._topics.get(topic)
+        loop = self._loop
+        if not sections or loop is None or loop.is_closed():
+            return
+        with self._pending_lock:
+            self._pending.update(sections)
+        loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def subscribe(self):
+        self._start()
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        async with self._snapshot_lock:
+            # Screens connecting together share one initial computation
+            if self._snapshot is None:
+                self._set_snapshot(await run_in_threadpool(self._compute, self._sections))
+        queue.put_nowait(self._snapshot_message)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    def stop(self):
+        # Cancel the refresh task without waiting for it
+        task, self._task = self._task, None
+        if task:
+            task.cancel()
+        return task
+
+    async def close(self):
+        task = self.stop()
+        if task:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def _start(self):
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._snapshot_lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+
+    def _set_snapshot(self, snapshot):
+        self._version += 1
+        self._snapshot = snapshot
+        self._snapshot_message = _encode("snapshot", snapshot, self._version)
+
+    async def _run(self):
+        # Full refreshes keep to their own schedule, however often local writes wake the feed
+        next_refresh = self._loop.time() + DASHBOARD_STREAM_REFRESH
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0, next_refresh - self._loop.time()))
+                # Coalesce the rest of the burst into this recomputation
+                await asyncio.sleep(DASHBOARD_STREAM_DEBOUNCE)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            with self._pending_lock:
+                sections, self._pending = self._pending, set()
+            if self._loop.time() >= next_refresh:
+                sections = set(self._sections)
+                next_refresh = self._loop.time() + DASHBOARD_STREAM_REFRESH
+
+            if not self._subscribers:
+                self._snapshot = None
+                continue
+
+            try:
+                async with self._snapshot_lock:
+                    updated = await run_in_threadpool(self._compute, sorted(sections))
+                    delta = {name: data for name, data in updated.items() if self._snapshot.get(name) != data}
+                    if not delta:
+                        continue
+                    self._set_snapshot({**self._snapshot, **delta})
+                    self._broadcast(_encode("delta", delta, self._version))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Keep the feed alive; the next change or refresh retries
+                logger.exception("Dashboard feed recomputation failed")
+                continue
+
+    def _broadcast(self, message: str):
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Slow client: drop its backlog and resync it with the full snapshot
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(self._snapshot_message)
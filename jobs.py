@@ -0,0 +1,263 @@
+"""
+Background jobs for long-running imports and exports.
+
+Jobs are recorded in the ``jobs`` table so their progress is visible from
+any worker process, and are executed by a small in-process thread pool.
+JOB_WORKERS bounds how many jobs run at once (and therefore how many
+database connections they hold) and JOB_MAX_PENDING bounds how many may be
+queued, so a burst of imports cannot starve regular API traffic.
+
+The process holding a queued or running job refreshes its ``heartbeat_at``
+every JOB_HEARTBEAT_SECONDS. A job whose heartbeat is older than
+JOB_STALE_SECONDS belonged to a process that died, and is marked failed at
+startup and before each submission, so it no longer counts as pending.
+"""
+
+import csv
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+import crud
+import database
+import tenancy
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", "20"))
+JOB_RETENTION_HOURS = int(os.getenv("JOB_RETENTION_HOURS", "24"))
+JOB_HEARTBEAT_SECONDS = int(os.getenv("JOB_HEARTBEAT_SECONDS", "30"))
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", str(JOB_HEARTBEAT_SECONDS * 4)))
+JOB_DIR = os.getenv("JOB_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "job_files"))
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+_futures = {}  # job id -> (future, tenant)
+_futures_lock = threading.Lock()
+_stopping = threading.Event()
+_heartbeat_thread = None
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobInterrupted(Exception):
+    pass
+
+
+def job_path(job_id: str, suffix: str):
+    os.makedirs(JOB_DIR, exist_ok=True)
+    return os.path.join(JOB_DIR, f"{job_id}{suffix}")
+
+
+def get_job(db, job_id: str):
+    return db.query(database.Job).filter(database.Job.id == job_id).first()
+
+
+def get_jobs(db, skip: int = 0, limit: int = 50):
+    return db.query(database.Job).order_by(database.Job.created_at.desc()).offset(skip).limit(limit).all()
+
+
+def submit(db, kind: str, job_id: str = None, input_path: str = None):
+    if kind not in _HANDLERS:
+        raise ValueError(f"Unknown job kind '{kind}'")
+
+    recover_stale(db)
+    pending = db.query(database.Job).filter(database.Job.status.in_(["queued", "running"])).count()
+    if pending >= JOB_MAX_PENDING:
+        raise JobQueueFull(f"{pending} jobs are already queued or running")
+
+    cleanup_expired(db)
+
+    db_job = database.Job(id=job_id or new_job_id(), kind=kind, status="queued", input_path=input_path,
+                          heartbeat_at=datetime.utcnow())
+    db.add(db_job)
+    db.commit()
+
+    # The job runs on a pool thread, outside the request's tenant context
+    tenant = tenancy.current_tenant()
+    with _futures_lock:
+        _futures[db_job.id] = (_executor.submit(_run, db_job.id, tenant), tenant)
+        _start_heartbeat()
+    return db_job
+
+
+def new_job_id():
+    return str(uuid.uuid4())
+
+
+def recover_stale(db):
+    # Fail jobs left queued or running by a process that stopped without finishing them
+    cutoff = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+    recovered = db.query(database.Job).filter(
+        database.Job.status.in_(["queued", "running"]),
+        func.coalesce(database.Job.heartbeat_at, database.Job.created_at) < cutoff
+    ).update(
+        {"status": "failed", "error": "Server stopped before the job finished", "finished_at": datetime.utcnow()},
+        synchronize_session=False
+    )
+    if recovered:
+        db.commit()
+    return recovered
+
+
+def _start_heartbeat():
+    # Called with _futures_lock held
+    global _heartbeat_thread
+    if _heartbeat_thread is None:
+        _heartbeat_thread = threading.Thread(target=_heartbeat, name="job-heartbeat", daemon=True)
+        _heartbeat_thread.start()
+
+
+def _heartbeat():
+    while not _stopping.wait(JOB_HEARTBEAT_SECONDS):
+        with _futures_lock:
+            job_ids_by_tenant = {}
+            for job_id, (future, tenant) in _futures.items():
+                job_ids_by_tenant.setdefault(tenant, []).append(job_id)
+        for tenant, job_ids in job_ids_by_tenant.items():
+            try:
+                with tenancy.write_session(tenant) as db:
+                    db.query(database.Job).filter(database.Job.id.in_(job_ids)).update(
+                        {"heartbeat_at": datetime.utcnow()}, synchronize_session=False
+                    )
+                    db.commit()
+            except Exception:
+                # A missed beat is retried on the next one, well before the job looks stale
+                continue
+
+
+def cleanup_expired(db):
+    # Remove artifacts and records of finished jobs past the retention window
+    cutoff = datetime.utcnow() - timedelta(hours=JOB_RETENTION_HOURS)
+    expired = db.query(database.Job).filter(
+        database.Job.status.in_(["completed", "failed"]),
+        database.Job.finished_at < cutoff
+    ).all()
+    for db_job in expired:
+        for path in (db_job.input_path, db_job.result_path):
+            if path and os.path.exists(path):
+                os.remove(path)
+        db.delete(db_job)
+    if expired:
+        db.commit()
+
+
+def shutdown():
+    # Fail queued jobs that never started and ask running jobs to stop at the next chunk
+    _stopping.set()
+    with _futures_lock:
+        cancelled = {}
+        for job_id, (future, tenant) in _futures.items():
+            if future.cancel():
+                cancelled.setdefault(tenant, []).append(job_id)
+    _executor.shutdown(wait=False, cancel_futures=True)
+    for tenant, job_ids in cancelled.items():
+        with tenancy.write_session(tenant) as db:
+            db.query(database.Job).filter(database.Job.id.in_(job_ids)).update(
+                {"status": "failed", "error": "Server shut down before the job started",
+                 "finished_at": datetime.utcnow()},
+                synchronize_session=False
+            )
+            db.commit()
+
+
+def _update_job(job_id: str, **values):
+    # Job bookkeeping uses its own short session so it never interferes with
+    # the handler's transaction or streaming cursor
+    with tenancy.write_session() as db:
+        db.query(database.Job).filter(database.Job.id == job_id).update(values, synchronize_session=False)
+        db.commit()
+
+
+def _run(job_id: str, tenant: str):
+    token = tenancy.set_tenant(tenant)
+    try:
+        _run_job(job_id)
+    finally:
+        tenancy.reset_tenant(token)
+        with _futures_lock:
+            _futures.pop(job_id, None)
+
+
+def _run_job(job_id: str):
+    # Load the job on its own; a writing handler must start without an open
+    # transaction, since progress updates queue for the same writer lock
+    reader = tenancy.session()
+    try:
+        db_job = get_job(reader, job_id)
+    finally:
+        reader.close()
+    if db_job is None:
+        return
+
+    handler, writes = _HANDLERS[db_job.kind]
+    db = tenancy.session(write=writes)
+    try:
+        _update_job(job_id, status="running", started_at=datetime.utcnow())
+        try:
+            values = handler(db, db_job)
+            values["status"] = "completed"
+        except JobInterrupted:
+            db.rollback()
+            values = {"status": "failed", "error": "Server shut down while the job was running"}
+        except Exception as e:
+            db.rollback()
+            values = {"status": "failed", "error": str(e)}
+    finally:
+        db.close()
+
+    values["finished_at"] = datetime.utcnow()
+    _update_job(job_id, **values)
+
+
+def _report_progress(job_id: str, processed: int, failed: int = 0):
+    if _stopping.is_set():
+        raise JobInterrupted()
+    _update_job(job_id, rows_processed=processed, rows_failed=failed)
+    # Give request threads a chance at the GIL between chunks
+    time.sleep(0)
+
+
+def _import_patients(db, db_job):
+    job_id, input_path = db_job.id, db_job.input_path
+    with open(input_path, newline="", encoding="utf-8") as f:
+        _update_job(job_id, rows_total=max(sum(1 for _ in csv.reader(f)) - 1, 0))
+
+    result = crud.import_patients_csv_file(
+        db, input_path,
+        progress=lambda imported, failed: _report_progress(job_id, imported + failed, failed)
+    )
+    return {
+        "rows_processed": result["imported"] + result["failed"],
+        "rows_failed": result["failed"],
+        "error": "\n".join(result["errors"]) or None
+    }
+
+
+def _export_patients(db, db_job):
+    job_id = db_job.id
+    _update_job(job_id, rows_total=db.query(database.Patient).count())
+
+    path = job_path(job_id, ".csv")
+    try:
+        exported_count = crud.export_patients_csv_file(
+            db, path,
+            progress=lambda exported: _report_progress(job_id, exported)
+        )
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return {"rows_processed": exported_count, "result_path": path}
+
+
+# kind -> (handler, whether it writes to the database)
+_HANDLERS = {
+    "import_patients": (_import_patients, True),
+    "export_patients": (_export_patients, False),
+}
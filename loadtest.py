@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Load test for the production runner.
+
+Starts run_production.py once per worker count, drives it with a fixed
+number of keep-alive client processes for a fixed duration and prints
+throughput and latency per configuration, so scaling with workers can be
+measured on the target machine:
+
+    python loadtest.py --workers 1 2 4 8 --clients 64 --duration 20 --path /patients/?limit=20
+
+Every client connects from the same address, so the per-client admission
+rate limits would reject almost all requests with 429. The started server
+therefore runs with ADMISSION_INTERACTIVE_RATE=0 and ADMISSION_HEAVY_RATE=0;
+pass --rate-limit to keep them (the concurrency limits always apply).
+
+Only the standard library is used. Run it on a machine with more cores than
+the largest worker count (or drive it from a second machine with --url) so
+the load generator itself is not the bottleneck.
+"""
+
+import argparse
+import http.client
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def _client(url, path, deadline, queue):
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+    latencies = []
+    errors = {}  # status code, or "connection" -> count
+    while time.time() < deadline:
+        started = time.perf_counter()
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            errors["connection"] = errors.get("connection", 0) + 1
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+            continue
+        # Only successful requests count towards throughput and latency
+        if response.status == 200:
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors[response.status] = errors.get(response.status, 0) + 1
+    conn.close()
+    queue.put((latencies, errors))
+
+
+def _wait_until_ready(url, timeout=30):
+    parts = urlsplit(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=2)
+            conn.request("GET", "/")
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not become ready in {timeout}s")
+
+
+def run_round(url, path, clients, duration):
+    queue = multiprocessing.Queue()
+    deadline = time.time() + duration
+    processes = [
+        multiprocessing.Process(target=_client, args=(url, path, deadline, queue))
+        for _ in range(clients)
+    ]
+    for process in processes:
+        process.start()
+    latencies, errors = [], {}
+    for _ in processes:
+        client_latencies, client_errors = queue.get()
+        latencies.extend(client_latencies)
+        for kind, count in client_errors.items():
+            errors[kind] = errors.get(kind, 0) + count
+    for process in processes:
+        process.join()
+
+    latencies.sort()
+
+    def percentile(p):
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    return {
+        "requests": len(latencies),
+        "errors": sum(errors.values()),
+        "error_kinds": ", ".join(f"{kind}: {count}" for kind, count in sorted(errors.items(), key=str)),
+        "rps": len(latencies) / duration,
+        "p50": percentile(0.50),
+        "p99": percentile(0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure throughput per worker count")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--duration", type=int, default=15)
+    parser.add_argument("--path", default="/patients/?limit=20")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--url", default=None,
+                        help="benchmark an already running server instead of starting one")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="keep the per-client admission rate limits on the started server")
+    args = parser.parse_args()
+
+    print(f"{'workers':>7} {'ok':>9} {'errors':>6} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'speedup':>7}")
+    env = dict(os.environ)
+    if not args.rate_limit:
+        env.update(ADMISSION_INTERACTIVE_RATE="0", ADMISSION_HEAVY_RATE="0")
+    baseline = None
+    for workers in ([None] if args.url else args.workers):
+        url = args.url or f"http://127.0.0.1:{args.port}"
+        server = None
+        if not args.url:
+            server = subprocess.Popen(
+                [sys.executable, os.path.join(current_dir, "run_production.py"),
+                 "--host", "127.0.0.1", "--port", str(args.port), "--workers", str(workers)],
+                cwd=current_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+        try:
+            _wait_until_ready(url)
+            result = run_round(url, args.path, args.clients, args.duration)
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+        baseline = baseline or result["rps"]
+        speedup = result["rps"] / baseline if baseline else 0.0
+        print(f"{workers or '-':>7} {result['requests']:>9} {result['errors']:>6} {result['rps']:>9.1f} "
+              f"{result['p50']:>8.1f} {result['p99']:>8.1f} {speedup:>6.2f}x"
+              + (f"   ({result['error_kinds']})" if result["errors"] else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,121 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Query, Request
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session
 from typing import List, Optional
-from datetime import datetime
-import io
-import crud, schemas, database
-
-# Create tables on startup
-database.create_tables()
+from datetime import datetime, date
+from contextlib import asynccontextmanager
+import asyncio
+import os
+import shutil
+import crud, schemas, database, jobs, events, search, tenancy, admission
+
+# Create tables on startup; tenant databases are set up by manage.py init
+if not tenancy.ENABLED:
+    tenancy.initialize_database(database.engine)
+    with database.write_session() as startup_db:
+        jobs.recover_stale(startup_db)
+
+def _compute_dashboard_sections(tenant, sections):
+    db = tenancy.session(tenant)
+    try:
+        return crud.get_dashboard_stats(db, sections=sections)
+    finally:
+        db.close()
+
+# One shared live dashboard computation per tenant and process, fed by crud
+# write paths; it only exists while a screen of that tenant is connected
+dashboard_feeds = {}
+dashboard_feed_users = {}  # tenant -> open /analytics/stream requests
+
+def _acquire_dashboard_feed(tenant):
+    feed = dashboard_feeds.get(tenant)
+    if feed is None:
+        feed = dashboard_feeds[tenant] = events.DashboardFeed(
+            lambda sections: _compute_dashboard_sections(tenant, sections), crud.DASHBOARD_TOPICS
+        )
+    dashboard_feed_users[tenant] = dashboard_feed_users.get(tenant, 0) + 1
+    return feed
+
+def _release_dashboard_feed(tenant):
+    dashboard_feed_users[tenant] -= 1
+    if not dashboard_feed_users[tenant]:
+        del dashboard_feed_users[tenant]
+        dashboard_feeds.pop(tenant).stop()
+
+def _notify_dashboard(topic):
+    # Writes publish from the request's (or job's) context, so the tenant is known
+    feed = dashboard_feeds.get(tenancy.current_tenant())
+    if feed is not None:
+        feed.notify(topic)
+
+events.subscribe_changes(_notify_dashboard)
+
+# List endpoints return at most MAX_PAGE_LIMIT rows per page; larger result
+# sets are streamed as NDJSON (?stream=1 or Accept: application/x-ndjson)
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = int(os.getenv("MAX_PAGE_LIMIT", "500"))
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def _wants_stream(request: Request):
+    # The same check admission control uses to class the request as heavy
+    return admission.is_stream(request.url.query, request.headers)
+
+def _page_limit(limit: Optional[int]):
+    if limit is None:
+        return DEFAULT_PAGE_LIMIT
+    if limit > MAX_PAGE_LIMIT:
+        raise HTTPException(
+            status_code=400,
+            detail=f"limit cannot exceed {MAX_PAGE_LIMIT}; use ?stream=1 or Accept: {NDJSON_MEDIA_TYPE} for larger result sets"
+        )
+    return limit
+
+def _ndjson_response(open_rows, schema):
+    # The stream outlives the request's own session, so it gets a session of its own
+    db = tenancy.session()
+    try:
+        rows = open_rows(db)
+    except ValueError as e:
+        db.close()
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception:
+        db.close()
+        raise
+
+    def generate():
+        try:
+            for row in rows:
+                yield schema.model_validate(row).model_dump_json() + "\n"
+        finally:
+            db.close()
+
+    return StreamingResponse(generate(), media_type=NDJSON_MEDIA_TYPE)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    for feed in list(dashboard_feeds.values()):
+        await feed.close()
+    jobs.shutdown()
+    # Close pooled connections once in-flight requests have drained
+    tenancy.dispose_all()
 
 app = FastAPI(
     title="Clinic Management API",
     description="A comprehensive clinic management system API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
-# CORS middleware
+# Per-class concurrency, queueing and rate limits; runs inside the tenant middleware
+app.add_middleware(admission.AdmissionMiddleware)
+
+# Resolve the clinic for each request (no-op unless tenancy is configured)
+app.add_middleware(tenancy.TenantMiddleware)
+
+# CORS middleware, outermost so preflight requests need no tenant
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # In production, specify actual frontend URLs
@@ -25,23 +124,46 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(OperationalError)
+async def database_error_handler(request: Request, exc: OperationalError):
+    # Heavy requests whose queries ran past the statement timeout
+    if admission.is_statement_timeout(exc):
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Query took too long; narrow the date range or try again later"},
+            headers={"Retry-After": "30"}
+        )
+    raise exc
+
 # Patient endpoints
 @app.post("/patients/", response_model=schemas.Patient)
-def create_patient(patient: schemas.PatientCreate, db: Session = Depends(database.get_db)):
+def create_patient(patient: schemas.PatientCreate, db: Session = Depends(tenancy.get_write_db)):
     return crud.create_patient(db=db, patient=patient)
 
 @app.get("/patients/", response_model=List[schemas.Patient])
 def read_patients(
-    skip: int = 0, 
-    limit: int = 100, 
+    request: Request,
+    skip: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
     search: Optional[str] = None,
-    db: Session = Depends(database.get_db)
+    sort_by: Optional[str] = None,
+    order: str = "asc",
+    stream: bool = False,
+    db: Session = Depends(tenancy.get_db)
 ):
-    patients = crud.get_patients(db, skip=skip, limit=limit, search=search)
+    if _wants_stream(request):
+        return _ndjson_response(
+            lambda stream_db: crud.stream_patients(stream_db, skip=skip, limit=limit, search=search, sort_by=sort_by, order=order),
+            schemas.Patient
+        )
+    try:
+        patients = crud.get_patients(db, skip=skip, limit=_page_limit(limit), search=search, sort_by=sort_by, order=order)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return patients
 
 @app.get("/patients/{patient_id}", response_model=schemas.Patient)
-def read_patient(patient_id: int, db: Session = Depends(database.get_db)):
+def read_patient(patient_id: int, db: Session = Depends(tenancy.get_db)):
     db_patient = crud.get_patient(db, patient_id=patient_id)
     if db_patient is None:
         raise HTTPException(status_code=404, detail="Patient not found")
@@ -51,7 +173,7 @@ def read_patient(patient_id: int, db: Session = Depends(database.get_db)):
 def update_patient(
     patient_id: int, 
     patient: schemas.PatientUpdate, 
-    db: Session = Depends(database.get_db)
+    db: Session = Depends(tenancy.get_write_db)
 ):
     db_patient = crud.update_patient(db, patient_id=patient_id, patient=patient)
     if db_patient is None:
@@ -59,7 +181,7 @@ def update_patient(
     return db_patient
 
 @app.delete("/patients/{patient_id}")
-def delete_patient(patient_id: int, db: Session = Depends(database.get_db)):
+def delete_patient(patient_id: int, db: Session = Depends(tenancy.get_write_db)):
     try:
         db_patient = crud.delete_patient(db, patient_id=patient_id)
         if db_patient is None:
@@ -70,19 +192,30 @@ def delete_patient(patient_id: int, db: Session = Depends(database.get_db)):
 
 # Appointment endpoints
 @app.post("/appointments/", response_model=schemas.Appointment)
-def create_appointment(appointment: schemas.AppointmentCreate, db: Session = Depends(database.get_db)):
+def create_appointment(appointment: schemas.AppointmentCreate, db: Session = Depends(tenancy.get_write_db)):
     try:
         return crud.create_appointment(db=db, appointment=appointment)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
 @app.get("/appointments/", response_model=List[schemas.Appointment])
-def read_appointments(skip: int = 0, limit: int = 100, db: Session = Depends(database.get_db)):
-    appointments = crud.get_appointments(db, skip=skip, limit=limit)
+def read_appointments(
+    request: Request,
+    skip: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
+    stream: bool = False,
+    db: Session = Depends(tenancy.get_db)
+):
+    if _wants_stream(request):
+        return _ndjson_response(
+            lambda stream_db: crud.stream_appointments(stream_db, skip=skip, limit=limit),
+            schemas.Appointment
+        )
+    appointments = crud.get_appointments(db, skip=skip, limit=_page_limit(limit))
     return appointments
 
 @app.get("/appointments/{appointment_id}", response_model=schemas.Appointment)
-def read_appointment(appointment_id: int, db: Session = Depends(database.get_db)):
+def read_appointment(appointment_id: int, db: Session = Depends(tenancy.get_db)):
     db_appointment = crud.get_appointment(db, appointment_id=appointment_id)
     if db_appointment is None:
         raise HTTPException(status_code=404, detail="Appointment not found")
@@ -92,7 +225,7 @@ def read_appointment(appointment_id: int, db: Session = Depends(database.get_db)
 def update_appointment(
     appointment_id: int, 
     appointment: schemas.AppointmentUpdate, 
-    db: Session = Depends(database.get_db)
+    db: Session = Depends(tenancy.get_write_db)
 ):
     db_appointment = crud.update_appointment(db, appointment_id=appointment_id, appointment=appointment)
     if db_appointment is None:
@@ -100,7 +233,7 @@ def update_appointment(
     return db_appointment
 
 @app.delete("/appointments/{appointment_id}")
-def delete_appointment(appointment_id: int, db: Session = Depends(database.get_db)):
+def delete_appointment(appointment_id: int, db: Session = Depends(tenancy.get_write_db)):
     db_appointment = crud.delete_appointment(db, appointment_id=appointment_id)
     if db_appointment is None:
         raise HTTPException(status_code=404, detail="Appointment not found")
@@ -108,24 +241,35 @@ def delete_appointment(appointment_id: int, db: Session = Depends(database.get_d
 
 # Payment endpoints
 @app.post("/payments/", response_model=schemas.Payment)
-def create_payment(payment: schemas.PaymentCreate, db: Session = Depends(database.get_db)):
+def create_payment(payment: schemas.PaymentCreate, db: Session = Depends(tenancy.get_write_db)):
     try:
         return crud.create_payment(db=db, payment=payment)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
 @app.get("/payments/", response_model=List[schemas.Payment])
-def read_payments(skip: int = 0, limit: int = 100, db: Session = Depends(database.get_db)):
-    payments = crud.get_payments(db, skip=skip, limit=limit)
+def read_payments(
+    request: Request,
+    skip: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
+    stream: bool = False,
+    db: Session = Depends(tenancy.get_db)
+):
+    if _wants_stream(request):
+        return _ndjson_response(
+            lambda stream_db: crud.stream_payments(stream_db, skip=skip, limit=limit),
+            schemas.Payment
+        )
+    payments = crud.get_payments(db, skip=skip, limit=_page_limit(limit))
     return payments
 
 @app.get("/payments/patient/{patient_id}", response_model=List[schemas.Payment])
-def read_payments_by_patient(patient_id: int, db: Session = Depends(database.get_db)):
+def read_payments_by_patient(patient_id: int, db: Session = Depends(tenancy.get_db)):
     payments = crud.get_payments_by_patient(db, patient_id=patient_id)
     return payments
 
 @app.get("/payments/{payment_id}", response_model=schemas.Payment)
-def read_payment(payment_id: int, db: Session = Depends(database.get_db)):
+def read_payment(payment_id: int, db: Session = Depends(tenancy.get_db)):
     db_payment = crud.get_payment(db, payment_id=payment_id)
     if db_payment is None:
         raise HTTPException(status_code=404, detail="Payment not found")
@@ -135,38 +279,65 @@ def read_payment(payment_id: int, db: Session = Depends(database.get_db)):
 def update_payment(
     payment_id: int, 
     payment: schemas.PaymentUpdate, 
-    db: Session = Depends(database.get_db)
+    db: Session = Depends(tenancy.get_write_db)
 ):
-    db_payment = crud.update_payment(db, payment_id=payment_id, payment=payment)
+    try:
+        db_payment = crud.update_payment(db, payment_id=payment_id, payment=payment)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if db_payment is None:
         raise HTTPException(status_code=404, detail="Payment not found")
     return db_payment
 
 @app.delete("/payments/{payment_id}")
-def delete_payment(payment_id: int, db: Session = Depends(database.get_db)):
-    db_payment = crud.delete_payment(db, payment_id=payment_id)
+def delete_payment(payment_id: int, db: Session = Depends(tenancy.get_write_db)):
+    try:
+        db_payment = crud.delete_payment(db, payment_id=payment_id)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if db_payment is None:
         raise HTTPException(status_code=404, detail="Payment not found")
     return {"message": "Payment deleted successfully"}
 
 # Analytics endpoints
 @app.get("/analytics/patients", response_model=schemas.PatientStats)
-def get_patient_analytics(db: Session = Depends(database.get_db)):
+def get_patient_analytics(db: Session = Depends(tenancy.get_db)):
     return crud.get_patient_stats(db)
 
 @app.get("/analytics/appointments", response_model=schemas.AppointmentStats)
-def get_appointment_analytics(db: Session = Depends(database.get_db)):
+def get_appointment_analytics(db: Session = Depends(tenancy.get_db)):
     return crud.get_appointment_stats(db)
 
 @app.get("/analytics/finance", response_model=schemas.FinanceStats)
-def get_finance_analytics(db: Session = Depends(database.get_db)):
+def get_finance_analytics(db: Session = Depends(tenancy.get_db)):
     return crud.get_finance_stats(db)
 
+@app.get("/analytics/timeseries", response_model=schemas.TimeSeries)
+def get_timeseries_analytics(
+    metric: str,
+    granularity: str = "day",
+    start_date: Optional[date] = Query(None, alias="from"),
+    end_date: Optional[date] = Query(None, alias="to"),
+    group_by: Optional[str] = None,
+    db: Session = Depends(tenancy.get_db)
+):
+    try:
+        return crud.get_timeseries(
+            db,
+            metric=metric,
+            granularity=granularity,
+            start_date=start_date,
+            end_date=end_date,
+            group_by=group_by
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/analytics/dashboard", response_model=schemas.DashboardStats)
 def get_dashboard_stats(
     start_date: Optional[str] = None, 
     end_date: Optional[str] = None,
-    db: Session = Depends(database.get_db)
+    db: Session = Depends(tenancy.get_db)
 ):
     # Parse date strings if provided
     parsed_start_date = None
@@ -176,21 +347,74 @@ def get_dashboard_stats(
     if end_date:
         parsed_end_date = datetime.strptime(end_date, "%Y-%m-%d").date()
     
-    patient_stats = crud.get_patient_stats(db, parsed_start_date, parsed_end_date)
-    appointment_stats = crud.get_appointment_stats(db)
-    finance_stats = crud.get_finance_stats(db)
-    visit_stats = crud.get_visit_stats(db)
+    return crud.get_dashboard_stats(db, parsed_start_date, parsed_end_date)
+
+def _term_analytics(db: Session, field: str, start_date, end_date, doctor, limit, granularity, term):
+    try:
+        return crud.get_term_stats(
+            db,
+            field=field,
+            start_date=start_date,
+            end_date=end_date,
+            doctor=doctor,
+            limit=limit,
+            granularity=granularity,
+            selected_terms=term
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/analytics/prescriptions", response_model=schemas.TermStats)
+def get_prescription_analytics(
+    start_date: Optional[date] = Query(None, alias="from"),
+    end_date: Optional[date] = Query(None, alias="to"),
+    doctor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=200),
+    granularity: Optional[str] = None,
+    term: Optional[List[str]] = Query(None),
+    db: Session = Depends(tenancy.get_db)
+):
+    return _term_analytics(db, "medicines", start_date, end_date, doctor, limit, granularity, term)
+
+@app.get("/analytics/diagnoses", response_model=schemas.TermStats)
+def get_diagnosis_analytics(
+    start_date: Optional[date] = Query(None, alias="from"),
+    end_date: Optional[date] = Query(None, alias="to"),
+    doctor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=200),
+    granularity: Optional[str] = None,
+    term: Optional[List[str]] = Query(None),
+    db: Session = Depends(tenancy.get_db)
+):
+    return _term_analytics(db, "diagnosis", start_date, end_date, doctor, limit, granularity, term)
+
+@app.get("/analytics/stream")
+async def stream_dashboard():
+    # Server-Sent Events: a full snapshot first, then only the sections that changed
+    tenant = tenancy.current_tenant()
+    
+    async def event_source():
+        # Taken inside the body, so the feed is released however the stream ends
+        dashboard_feed = _acquire_dashboard_feed(tenant)
+        try:
+            queue = await dashboard_feed.subscribe()
+            try:
+                while True:
+                    try:
+                        yield await asyncio.wait_for(queue.get(), timeout=events.DASHBOARD_STREAM_HEARTBEAT)
+                    except asyncio.TimeoutError:
+                        yield ": keep-alive\n\n"
+            finally:
+                dashboard_feed.unsubscribe(queue)
+        finally:
+            _release_dashboard_feed(tenant)
     
-    return {
-        "patient_stats": patient_stats,
-        "appointment_stats": appointment_stats,
-        "finance_stats": finance_stats,
-        "visit_stats": visit_stats
-    }
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(event_source(), media_type="text/event-stream", headers=headers)
 
 # Patient Visit endpoints
 @app.post("/visits/", response_model=schemas.PatientVisit)
-def create_visit(visit: schemas.PatientVisitCreate, db: Session = Depends(database.get_db)):
+def create_visit(visit: schemas.PatientVisitCreate, db: Session = Depends(tenancy.get_write_db)):
     try:
         return crud.create_visit(db=db, visit=visit)
     except ValueError as e:
@@ -198,18 +422,47 @@ def create_visit(visit: schemas.PatientVisitCreate, db: Session = Depends(databa
 
 @app.get("/visits/", response_model=List[schemas.PatientVisit])
 def read_visits(
-    skip: int = 0, 
-    limit: int = 100, 
+    request: Request,
+    skip: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
     patient_id: Optional[int] = None,
-    start_date: Optional[str] = None,
-    end_date: Optional[str] = None,
-    db: Session = Depends(database.get_db)
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    stream: bool = False,
+    db: Session = Depends(tenancy.get_db)
 ):
-    visits = crud.get_visits(db, skip=skip, limit=limit, patient_id=patient_id, start_date=start_date, end_date=end_date)
+    if _wants_stream(request):
+        return _ndjson_response(
+            lambda stream_db: crud.stream_visits(stream_db, skip=skip, limit=limit, patient_id=patient_id, start_date=start_date, end_date=end_date),
+            schemas.PatientVisit
+        )
+    visits = crud.get_visits(db, skip=skip, limit=_page_limit(limit), patient_id=patient_id, start_date=start_date, end_date=end_date)
     return visits
 
+@app.get("/visits/search", response_model=schemas.VisitSearchPage)
+def search_visits(
+    q: str,
+    start_date: Optional[date] = Query(None, alias="from"),
+    end_date: Optional[date] = Query(None, alias="to"),
+    doctor: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(tenancy.get_db)
+):
+    try:
+        return search.search_visits(
+            db, q,
+            start_date=start_date,
+            end_date=end_date,
+            doctor=doctor,
+            cursor=cursor,
+            limit=limit
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/visits/{visit_id}", response_model=schemas.PatientVisit)
-def read_visit(visit_id: int, db: Session = Depends(database.get_db)):
+def read_visit(visit_id: int, db: Session = Depends(tenancy.get_db)):
     db_visit = crud.get_visit(db, visit_id=visit_id)
     if db_visit is None:
         raise HTTPException(status_code=404, detail="Visit not found")
@@ -219,58 +472,92 @@ def read_visit(visit_id: int, db: Session = Depends(database.get_db)):
 def update_visit(
     visit_id: int, 
     visit: schemas.PatientVisitUpdate, 
-    db: Session = Depends(database.get_db)
+    db: Session = Depends(tenancy.get_write_db)
 ):
-    db_visit = crud.update_visit(db, visit_id=visit_id, visit=visit)
+    try:
+        db_visit = crud.update_visit(db, visit_id=visit_id, visit=visit)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if db_visit is None:
         raise HTTPException(status_code=404, detail="Visit not found")
     return db_visit
 
 @app.delete("/visits/{visit_id}")
-def delete_visit(visit_id: int, db: Session = Depends(database.get_db)):
-    db_visit = crud.delete_visit(db, visit_id=visit_id)
+def delete_visit(visit_id: int, db: Session = Depends(tenancy.get_write_db)):
+    try:
+        db_visit = crud.delete_visit(db, visit_id=visit_id)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if db_visit is None:
         raise HTTPException(status_code=404, detail="Visit not found")
     return {"message": "Visit deleted successfully"}
 
 @app.get("/analytics/visits", response_model=schemas.VisitStats)
-def get_visit_analytics(db: Session = Depends(database.get_db)):
+def get_visit_analytics(db: Session = Depends(tenancy.get_db)):
     return crud.get_visit_stats(db)
 
+# Delta sync endpoint
+@app.get("/sync", response_model=schemas.SyncBatch)
+def sync_changes(
+    since: Optional[str] = None,
+    limit: int = Query(500, ge=1, le=5000),
+    db: Session = Depends(tenancy.get_db)
+):
+    try:
+        return crud.get_changes(db, since=since, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 # Import/Export endpoints
-@app.get("/export/patients")
-def export_patients_csv(db: Session = Depends(database.get_db)):
-    df = crud.export_patients_csv(db)
-    
-    # Convert DataFrame to CSV string
-    output = io.StringIO()
-    df.to_csv(output, index=False)
-    output.seek(0)
-    
-    # Return as downloadable file
-    headers = {
-        'Content-Disposition': 'attachment; filename="patients_export.csv"'
-    }
-    
-    return StreamingResponse(
-        io.BytesIO(output.getvalue().encode()),
-        media_type="text/csv",
-        headers=headers
-    )
-
-@app.post("/import/patients")
-async def import_patients_csv(file: UploadFile = File(...), db: Session = Depends(database.get_db)):
+@app.post("/export/patients", status_code=202, response_model=schemas.Job)
+def export_patients_job(db: Session = Depends(tenancy.get_write_db)):
+    try:
+        return jobs.submit(db, "export_patients")
+    except jobs.JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+
+@app.post("/import/patients", status_code=202, response_model=schemas.Job)
+def import_patients_csv(file: UploadFile = File(...), db: Session = Depends(tenancy.get_write_db)):
     if not file.filename or not file.filename.endswith('.csv'):
         raise HTTPException(status_code=400, detail="File must be a CSV")
     
-    contents = await file.read()
-    csv_data = contents.decode('utf-8')
+    # Spool the upload to disk and process it in the background
+    job_id = jobs.new_job_id()
+    input_path = jobs.job_path(job_id, ".upload.csv")
+    with open(input_path, "wb") as f:
+        shutil.copyfileobj(file.file, f)
     
     try:
-        imported_count = crud.import_patients_csv(db, csv_data)
-        return {"message": f"Successfully imported {imported_count} patients"}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error importing CSV: {str(e)}")
+        return jobs.submit(db, "import_patients", job_id=job_id, input_path=input_path)
+    except jobs.JobQueueFull as e:
+        os.remove(input_path)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+
+# Background job endpoints
+@app.get("/jobs/", response_model=List[schemas.Job])
+def read_jobs(skip: int = 0, limit: int = 50, db: Session = Depends(tenancy.get_db)):
+    return jobs.get_jobs(db, skip=skip, limit=limit)
+
+@app.get("/jobs/{job_id}", response_model=schemas.Job)
+def read_job(job_id: str, db: Session = Depends(tenancy.get_db)):
+    db_job = jobs.get_job(db, job_id)
+    if db_job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return db_job
+
+@app.get("/jobs/{job_id}/download")
+def download_job_result(job_id: str, db: Session = Depends(tenancy.get_db)):
+    db_job = jobs.get_job(db, job_id)
+    if db_job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if db_job.download_url is None or not os.path.exists(db_job.result_path):
+        raise HTTPException(status_code=409, detail=f"Job has no downloadable result (status: {db_job.status})")
+    return FileResponse(db_job.result_path, media_type="text/csv", filename="patients_export.csv")
+
+# Admission control state for this worker process
+@app.get("/admin/admission")
+async def admission_stats():
+    return admission.stats()
 
 @app.get("/")
 def read_root():
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Maintenance commands for the clinic management backend.
+
+Usage:
+    python manage.py init
+    python manage.py partition [--table patient_visits|payments]
+    python manage.py ensure-partitions [--months-ahead 3]
+    python manage.py archive [--months 24]
+    python manage.py rebuild-counters [--check]
+    python manage.py rebuild-search
+    python manage.py backfill-terms
+
+When tenancy is configured, pass --tenant <id> before the command to run it
+against that clinic's database. ``init`` creates a new clinic's database
+tables; run it for every clinic after upgrading, too.
+"""
+
+import argparse
+import os
+import sys
+
+# Add current directory to Python path so the backend modules import
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import crud
+import database
+import partitioning
+import search
+import tenancy
+import terms
+
+
+def cmd_init(args):
+    if tenancy.ENABLED:
+        tenancy.provision(args.tenant)
+    else:
+        tenancy.initialize_database(database.engine)
+    print("✓ Tables, partitions and search index are up to date")
+
+
+def cmd_partition(args):
+    tables = [args.table] if args.table else list(partitioning.PARTITIONED_TABLES)
+    for table in tables:
+        if partitioning.convert_to_partitioned(tenancy.get_engine(), table, months_ahead=args.months_ahead):
+            print(f"✓ {table} is now partitioned by month")
+        else:
+            print(f"- {table} is already partitioned")
+
+
+def cmd_ensure_partitions(args):
+    partitioning.ensure_partitions(tenancy.get_engine(), months_ahead=args.months_ahead)
+    print(f"✓ Partitions exist up to {args.months_ahead} months ahead")
+
+
+def cmd_archive(args):
+    cutoff = partitioning.archive_cutoff(args.months)
+    db = tenancy.session(write=True)
+    try:
+        moved = partitioning.archive_before(db, cutoff)
+    finally:
+        db.close()
+    for table, count in moved.items():
+        print(f"✓ Archived {count} rows from {table} dated before {cutoff.isoformat()}")
+
+
+def cmd_rebuild_counters(args):
+    db = tenancy.session(write=True)
+    try:
+        mismatched = crud.rebuild_patient_counters(db, fix=not args.check)
+    finally:
+        db.close()
+    if not mismatched:
+        print("✓ Patient counters are consistent")
+    elif args.check:
+        print(f"✗ {len(mismatched)} patients have out-of-date counters: {mismatched[:20]}")
+        sys.exit(1)
+    else:
+        print(f"✓ Rebuilt counters for {len(mismatched)} patients")
+
+
+def cmd_rebuild_search(args):
+    search.ensure_search_index(tenancy.get_engine())
+    db = tenancy.session(write=True)
+    try:
+        indexed = search.rebuild_search_index(db)
+    finally:
+        db.close()
+    print(f"✓ Indexed {indexed} visits for full-text search")
+
+
+def cmd_backfill_terms(args):
+    db = tenancy.session(write=True)
+    try:
+        processed = terms.rebuild_terms(db)
+    finally:
+        db.close()
+    print(f"✓ Extracted medicine, diagnosis and test terms from {processed} visits")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Clinic backend maintenance commands")
+    parser.add_argument("--tenant", help="clinic to run the command for (when tenancy is configured)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    init = subparsers.add_parser("init", help="create or upgrade the database tables")
+    init.set_defaults(func=cmd_init)
+
+    partition = subparsers.add_parser("partition", help="convert tables to monthly partitions (PostgreSQL)")
+    partition.add_argument("--table", choices=list(partitioning.PARTITIONED_TABLES))
+    partition.add_argument("--months-ahead", type=int, default=partitioning.PARTITION_MONTHS_AHEAD)
+    partition.set_defaults(func=cmd_partition)
+
+    ensure = subparsers.add_parser("ensure-partitions", help="create upcoming monthly partitions (PostgreSQL)")
+    ensure.add_argument("--months-ahead", type=int, default=partitioning.PARTITION_MONTHS_AHEAD)
+    ensure.set_defaults(func=cmd_ensure_partitions)
+
+    archive = subparsers.add_parser("archive", help="move old visits and payments into archive tables")
+    archive.add_argument("--months", type=int, default=partitioning.ARCHIVE_AFTER_MONTHS,
+                         help="archive rows older than this many months")
+    archive.set_defaults(func=cmd_archive)
+
+    counters = subparsers.add_parser("rebuild-counters", help="recompute the per-patient counters")
+    counters.add_argument("--check", action="store_true", help="only report patients whose counters are wrong")
+    counters.set_defaults(func=cmd_rebuild_counters)
+
+    search_index = subparsers.add_parser("rebuild-search", help="re-index all visits for full-text search")
+    search_index.set_defaults(func=cmd_rebuild_search)
+
+    backfill = subparsers.add_parser("backfill-terms", help="re-extract prescription and diagnosis terms from all visits")
+    backfill.set_defaults(func=cmd_backfill_terms)
+
+    args = parser.parse_args(argv)
+    if tenancy.ENABLED:
+        if args.func is cmd_init:
+            if not args.tenant or not tenancy.TENANT_ID_PATTERN.match(args.tenant):
+                parser.error("--tenant must name the tenant to create")
+            try:
+                tenancy.database_url(args.tenant)
+            except tenancy.UnknownTenant as e:
+                parser.error(str(e))
+        elif not args.tenant or not tenancy.is_known(args.tenant):
+            parser.error("--tenant must name a provisioned tenant; create it with init first")
+        tenancy.set_tenant(args.tenant)
+    else:
+        database.create_tables()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Time-based partitioning and archival for patient_visits and payments.
+
+Two independent mechanisms keep queries on these ever-growing tables fast:
+
+* Postgres only: ``convert_to_partitioned`` turns a table into a
+  monthly RANGE-partitioned table, so date-filtered queries only scan the
+  months they need. ``ensure_partitions`` creates upcoming months and runs
+  at startup.
+* Any backend: ``archive_before`` records a new cut-off in
+  ``archive_state`` and then moves rows older than it into ``*_archive``
+  tables. The read paths in crud.py only consult the archive tables when the
+  requested date range reaches back past that cut-off.
+
+Both are run through ``manage.py``.
+"""
+
+import logging
+import os
+from datetime import date, datetime, time, timedelta
+from time import sleep
+
+from sqlalchemy import DateTime, and_, func, select, text
+
+import database
+
+logger = logging.getLogger(__name__)
+
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+ARCHIVE_AFTER_MONTHS = int(os.getenv("ARCHIVE_AFTER_MONTHS", "24"))
+# How long crud.py may keep using a cut-off it has read
+ARCHIVE_STATE_TTL = int(os.getenv("ARCHIVE_STATE_TTL", "60"))
+
+# table -> partition key column
+PARTITIONED_TABLES = {
+    "patient_visits": "visit_date",
+    "payments": "payment_date",
+}
+
+
+def _month_start(day: date):
+    return day.replace(day=1)
+
+
+def _add_months(day: date, months: int):
+    month_index = day.year * 12 + day.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def _months(first: date, last: date):
+    month = _month_start(first)
+    while month <= last:
+        yield month
+        month = _add_months(month, 1)
+
+
+def partition_name(table: str, month: date):
+    return f"{table}_p{month.year:04d}{month.month:02d}"
+
+
+def is_partitioned(conn, table: str):
+    if conn.dialect.name != "postgresql":
+        return False
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = :table AND pg_table_is_visible(c.oid)"
+    ), {"table": table}).first() is not None
+
+
+def _create_partition(conn, table: str, month: date):
+    name = partition_name(table, month)
+    # A savepoint per partition, so a clash with rows already sitting in the
+    # default partition only skips that month
+    with conn.begin_nested():
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_add_months(month, 1).isoformat()}')"
+        ))
+
+
+def ensure_partitions(engine, months_ahead: int = PARTITION_MONTHS_AHEAD):
+    """Create monthly partitions from the current month up to ``months_ahead`` months ahead."""
+    this_month = _month_start(datetime.utcnow().date())
+    with engine.begin() as conn:
+        for table in PARTITIONED_TABLES:
+            if not is_partitioned(conn, table):
+                continue
+            for month in _months(this_month, _add_months(this_month, months_ahead)):
+                try:
+                    _create_partition(conn, table, month)
+                except Exception as e:
+                    logger.warning("Could not create partition %s: %s", partition_name(table, month), e)
+
+
+def convert_to_partitioned(engine, table: str, months_ahead: int = PARTITION_MONTHS_AHEAD):
+    """Rebuild a plain Postgres table as a monthly RANGE-partitioned table, in one transaction."""
+    if engine.dialect.name != "postgresql":
+        raise ValueError("Partitioning is only supported on PostgreSQL")
+    if table not in PARTITIONED_TABLES:
+        raise ValueError(f"Table '{table}' cannot be partitioned")
+
+    column = PARTITIONED_TABLES[table]
+    legacy = f"{table}_unpartitioned"
+    with engine.begin() as conn:
+        if is_partitioned(conn, table):
+            return False
+
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": table}).scalar()
+        first, last = conn.execute(text(f"SELECT min({column}), max({column}) FROM {table}")).one()
+        today = datetime.utcnow().date()
+        first = first.date() if isinstance(first, datetime) else (first or today)
+        last = last.date() if isinstance(last, datetime) else (last or today)
+
+        # Move the old table and its index names out of the way
+        conn.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+        conn.execute(text(f"ALTER TABLE {legacy} RENAME CONSTRAINT {table}_pkey TO {legacy}_pkey"))
+        index_names = conn.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE tablename = :table AND indexname <> :pkey"
+        ), {"table": legacy, "pkey": f"{legacy}_pkey"}).scalars().all()
+        for name in index_names:
+            conn.execute(text(f'ALTER INDEX "{name}" RENAME TO "{name[:50]}_unpartitioned"'))
+        # The partition key is part of the primary key, so it cannot be NULL
+        conn.execute(text(f"UPDATE {legacy} SET {column} = now() WHERE {column} IS NULL"))
+
+        conn.execute(text(
+            f"CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+            f"PARTITION BY RANGE ({column})"
+        ))
+        conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL"))
+        conn.execute(text(f"ALTER TABLE {table} ADD PRIMARY KEY (id, {column})"))
+        # Every index the model defines, the partition key's included
+        for index in database.Base.metadata.tables[table].indexes:
+            index.create(conn)
+        conn.execute(text(f"ALTER TABLE {table} ADD FOREIGN KEY (patient_id) REFERENCES patients (id)"))
+
+        for month in _months(first, _add_months(max(last, today), months_ahead)):
+            _create_partition(conn, table, month)
+        conn.execute(text(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT"))
+
+        conn.execute(text(f"INSERT INTO {table} SELECT * FROM {legacy}"))
+        if sequence:
+            conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id"))
+        conn.execute(text(f"DROP TABLE {legacy}"))
+    return True
+
+
+def archive_cutoff(months: int = ARCHIVE_AFTER_MONTHS):
+    return _add_months(_month_start(datetime.utcnow().date()), -months)
+
+
+def _reuses_ids(db, table: str):
+    # SQLite tables created without AUTOINCREMENT give new rows max(id) + 1
+    if db.get_bind().dialect.name != "sqlite":
+        return False
+    sql = db.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :table"), {"table": table}).scalar()
+    return "AUTOINCREMENT" not in (sql or "").upper()
+
+
+def archive_before(db, cutoff: date, settle_seconds: float = ARCHIVE_STATE_TTL):
+    """Move rows dated before ``cutoff`` into the archive tables, one month per transaction.
+
+    The new cut-off is recorded first, so reads reaching back past it already
+    include the archive tables while rows move. When the cut-off moves, rows
+    wait ``settle_seconds`` first, so every process has dropped its cached copy.
+    """
+    raised = False
+    for table_name in (model.__tablename__ for model in database.ARCHIVES):
+        # Only ever move the watermark forward
+        state = db.query(database.ArchiveState).filter(database.ArchiveState.table_name == table_name).first()
+        if state is None:
+            db.add(database.ArchiveState(table_name=table_name, archived_before=cutoff))
+            raised = True
+        elif state.archived_before < cutoff:
+            state.archived_before = cutoff
+            raised = True
+    db.commit()
+    if raised and settle_seconds:
+        logger.info("Recorded archive cut-off %s; waiting %ss before moving rows", cutoff, settle_seconds)
+        sleep(settle_seconds)
+
+    moved = {}
+    for model, (archive_model, column_name) in database.ARCHIVES.items():
+        live = model.__table__
+        archive = archive_model.__table__
+        date_column = live.c[column_name]
+        columns = [column.name for column in live.columns if column.name in archive.c]
+        table_name = live.name
+        moved[table_name] = 0
+        # On such tables the highest id stays live, so archived ids are never handed out again
+        keep_id = db.execute(select(func.max(live.c.id))).scalar() if _reuses_ids(db, table_name) else None
+
+        first = db.execute(select(func.min(date_column))).scalar()
+        if first is not None:
+            first = first.date() if isinstance(first, datetime) else first
+            for month in _months(first, cutoff - timedelta(days=1)):
+                upper = min(_add_months(month, 1), cutoff)
+                if isinstance(date_column.type, DateTime):
+                    upper = datetime.combine(upper, time.min)
+                condition = date_column < upper
+                if keep_id is not None:
+                    condition = and_(condition, live.c.id < keep_id)
+                db.execute(archive.insert().from_select(
+                    columns, select(*[live.c[name] for name in columns]).where(condition)
+                ))
+                moved[table_name] += db.execute(live.delete().where(condition)).rowcount
+                db.commit()
+    return moved
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Production runner for the clinic management backend.
+
+Starts a pre-forked pool of uvicorn workers under gunicorn: the app is
+imported once in the master (tables are created there) and then forked,
+every worker runs on uvloop/httptools when available, and on shutdown each
+worker drains in-flight requests before disposing of its connection pool.
+
+Usage:
+    python run_production.py --workers 4 --port 8000
+
+All options can also be set through environment variables (WEB_CONCURRENCY,
+HOST, PORT, BACKLOG, KEEP_ALIVE, GRACEFUL_TIMEOUT, ...). On platforms without
+gunicorn (Windows) it falls back to uvicorn's own multi-process supervisor.
+"""
+
+import argparse
+import os
+import sys
+
+# Add current directory to Python path so "main:app" resolves from anywhere
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, current_dir)
+
+
+def _module_available(name):
+    try:
+        __import__(name)
+        return True
+    except ImportError:
+        return False
+
+
+LOOP = "uvloop" if _module_available("uvloop") else "asyncio"
+HTTP = "httptools" if _module_available("httptools") else "h11"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the clinic backend with multiple workers")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int,
+                        default=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+                        help="number of worker processes (default: number of cores)")
+    parser.add_argument("--backlog", type=int, default=int(os.getenv("BACKLOG", "2048")),
+                        help="maximum number of pending connections")
+    parser.add_argument("--keep-alive", type=int, default=int(os.getenv("KEEP_ALIVE", "5")),
+                        help="seconds to keep idle client connections open")
+    parser.add_argument("--graceful-timeout", type=int, default=int(os.getenv("GRACEFUL_TIMEOUT", "30")),
+                        help="seconds a worker may spend draining in-flight requests on shutdown")
+    parser.add_argument("--timeout", type=int, default=int(os.getenv("WORKER_TIMEOUT", "60")),
+                        help="seconds before an unresponsive worker is restarted")
+    parser.add_argument("--max-requests", type=int, default=int(os.getenv("MAX_REQUESTS", "0")),
+                        help="restart a worker after this many requests (0 disables)")
+    parser.add_argument("--access-log", action="store_true",
+                        default=os.getenv("ACCESS_LOG", "").lower() in ("1", "true", "yes"),
+                        help="log every request (off by default in production)")
+    return parser.parse_args(argv)
+
+
+def run_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+    try:
+        from uvicorn_worker import UvicornWorker
+    except ImportError:
+        from uvicorn.workers import UvicornWorker
+
+    class ProductionWorker(UvicornWorker):
+        CONFIG_KWARGS = {"loop": LOOP, "http": HTTP, "lifespan": "on"}
+
+    def post_fork(server, worker):
+        # Connections opened by the master while preloading must not be shared
+        import tenancy
+        tenancy.dispose_all(close=False)
+
+    def worker_exit(server, worker):
+        import tenancy
+        tenancy.dispose_all()
+
+    class ProductionApplication(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": f"{args.host}:{args.port}",
+                "workers": args.workers,
+                "worker_class": ProductionWorker,
+                "preload_app": True,
+                "backlog": args.backlog,
+                "keepalive": args.keep_alive,
+                "graceful_timeout": args.graceful_timeout,
+                "timeout": args.timeout,
+                "max_requests": args.max_requests,
+                "max_requests_jitter": args.max_requests // 10,
+                "accesslog": "-" if args.access_log else None,
+                "errorlog": "-",
+                "post_fork": post_fork,
+                "worker_exit": worker_exit,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            import main
+            return main.app
+
+    ProductionApplication().run()
+
+
+def run_uvicorn(args):
+    import uvicorn
+    uvicorn.run("main:app",
+                host=args.host,
+                port=args.port,
+                workers=args.workers,
+                loop=LOOP,
+                http=HTTP,
+                backlog=args.backlog,
+                timeout_keep_alive=args.keep_alive,
+                timeout_graceful_shutdown=args.graceful_timeout,
+                limit_max_requests=args.max_requests or None,
+                access_log=args.access_log)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    print(f"Starting Clinic Management Backend with {args.workers} worker(s) "
+          f"on {args.host}:{args.port} (loop={LOOP}, http={HTTP})")
+
+    if _module_available("gunicorn") and os.name != "nt":
+        run_gunicorn(args)
+    else:
+        run_uvicorn(args)
+
+
+if __name__ == "__main__":
+    main()
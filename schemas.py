@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from datetime import datetime, date
-from typing import Optional, List
+from typing import Optional, List, Dict
 
 # Patient Schemas
 class PatientBase(BaseModel):
@@ -22,6 +22,14 @@ class Patient(PatientBase):
     id: int
     created_at: datetime
     
+    # Maintained per-patient counters
+    visit_count: int = 0
+    appointment_count: int = 0
+    payment_count: int = 0
+    payment_total: float = 0.0
+    last_visit_date: Optional[date] = None
+    next_visit_date: Optional[date] = None
+    
     class Config:
         from_attributes = True
 
@@ -95,6 +103,76 @@ class PatientVisit(PatientVisitBase):
     class Config:
         from_attributes = True
 
+class VisitSearchResult(BaseModel):
+    visit_id: int
+    patient_id: int
+    visit_date: date
+    doctor_name: Optional[str] = None
+    rank: float
+    snippet: str  # matching text with terms wrapped in <b></b>
+
+class VisitSearchPage(BaseModel):
+    items: List[VisitSearchResult]
+    next_cursor: Optional[str] = None
+
+# Delta Sync Schemas
+class SyncPatient(PatientBase):
+    id: int
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+class SyncAppointment(AppointmentBase):
+    id: int
+    updated_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+class SyncPayment(PaymentBase):
+    id: int
+    payment_date: datetime
+    updated_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+class SyncVisit(PatientVisitBase):
+    id: int
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+class SyncBatch(BaseModel):
+    token: str  # pass back as ?since= on the next call
+    has_more: bool  # call again straight away with the new token
+    patients: List[SyncPatient]
+    appointments: List[SyncAppointment]
+    payments: List[SyncPayment]
+    visits: List[SyncVisit]
+    deleted: Dict[str, List[int]]  # ids deleted per table since the token
+
+# Background Job Schemas
+class Job(BaseModel):
+    id: str
+    kind: str  # import_patients/export_patients
+    status: str  # queued/running/completed/failed
+    rows_total: Optional[int] = None
+    rows_processed: int = 0
+    rows_failed: int = 0
+    error: Optional[str] = None
+    download_url: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
 # Analytics Schemas
 class PatientStats(BaseModel):
     total_patients: int
@@ -112,6 +190,28 @@ class FinanceStats(BaseModel):
     monthly_revenue: float
     payment_mode_breakdown: List[dict]
 
+class TimeSeries(BaseModel):
+    metric: str  # revenue/visits/appointments/new_patients
+    granularity: str  # day/week/month
+    start_date: date
+    end_date: date
+    group_by: Optional[str] = None  # payment_mode/doctor/visit_type
+    series: List[dict]
+
+class TermCount(BaseModel):
+    term: str
+    visits: int
+    patients: int
+
+class TermStats(BaseModel):
+    field: str  # medicines/diagnosis
+    start_date: date
+    end_date: date
+    doctor: Optional[str] = None
+    granularity: Optional[str] = None  # day/week/month when trends were requested
+    items: List[TermCount]
+    series: Optional[List[dict]] = None
+
 class VisitStats(BaseModel):
     total_visits: int
     new_visits: int
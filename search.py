@@ -0,0 +1,199 @@
+"""
+Full-text search over clinical visit notes.
+
+Visits are indexed into a ``visit_search`` side table whenever crud.py
+creates, updates or deletes them:
+
+* PostgreSQL: a weighted ``tsvector`` column with a GIN index; ranked with
+  ``ts_rank_cd`` and highlighted with ``ts_headline``.
+* SQLite: an FTS5 virtual table keyed by the visit id; ranked with ``bm25``
+  and highlighted with ``snippet``.
+
+Archived visits stay in the index, so searches cover them too. Results are
+ordered by relevance and paged with an opaque (rank, visit id) cursor, so
+deep pages cost the same as the first one.
+"""
+
+import base64
+import json
+import os
+import re
+from datetime import date
+from typing import Optional
+
+from sqlalchemy import text
+
+import database
+
+SEARCH_LANGUAGE = os.getenv("SEARCH_LANGUAGE", "english")
+
+# field -> weight; diagnosis and prescriptions matter more than free-form notes
+SEARCH_FIELDS = {
+    "diagnosis": ("A", 4.0),
+    "medicines": ("B", 3.0),
+    "tests": ("B", 3.0),
+    "observation": ("C", 2.0),
+    "notes": ("D", 1.0),
+}
+
+
+def _is_postgres(bind):
+    return bind.dialect.name == "postgresql"
+
+
+def ensure_search_index(engine):
+    with engine.begin() as conn:
+        if _is_postgres(conn):
+            conn.execute(text(
+                "CREATE TABLE IF NOT EXISTS visit_search ("
+                " visit_id INTEGER PRIMARY KEY,"
+                " patient_id INTEGER NOT NULL,"
+                " visit_date DATE NOT NULL,"
+                " doctor_name TEXT,"
+                " body TEXT NOT NULL,"
+                " document TSVECTOR NOT NULL)"
+            ))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_visit_search_document ON visit_search USING GIN (document)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_visit_search_visit_date ON visit_search (visit_date)"))
+        else:
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS visit_search USING fts5("
+                + ", ".join(SEARCH_FIELDS)
+                + ", patient_id UNINDEXED, visit_date UNINDEXED, doctor_name UNINDEXED,"
+                " tokenize = 'porter unicode61')"
+            ))
+
+
+def index_visit(db, visit):
+    """Add or replace a visit in the search index, inside the caller's transaction."""
+    values = {field: getattr(visit, field) or "" for field in SEARCH_FIELDS}
+    values.update(
+        visit_id=visit.id,
+        patient_id=visit.patient_id,
+        visit_date=visit.visit_date.isoformat(),
+        doctor_name=visit.doctor_name,
+    )
+    if _is_postgres(db.get_bind()):
+        document = " || ".join(
+            f"setweight(to_tsvector(CAST(:language AS regconfig), :{field}), '{weight}')"
+            for field, (weight, _) in SEARCH_FIELDS.items()
+        )
+        values["language"] = SEARCH_LANGUAGE
+        values["body"] = "\n".join(values[field] for field in SEARCH_FIELDS if values[field])
+        db.execute(text(
+            "INSERT INTO visit_search (visit_id, patient_id, visit_date, doctor_name, body, document) "
+            f"VALUES (:visit_id, :patient_id, CAST(:visit_date AS DATE), :doctor_name, :body, {document}) "
+            "ON CONFLICT (visit_id) DO UPDATE SET patient_id = EXCLUDED.patient_id, visit_date = EXCLUDED.visit_date, "
+            "doctor_name = EXCLUDED.doctor_name, body = EXCLUDED.body, document = EXCLUDED.document"
+        ), values)
+    else:
+        remove_visit(db, visit.id)
+        columns = list(SEARCH_FIELDS) + ["patient_id", "visit_date", "doctor_name"]
+        db.execute(text(
+            f"INSERT INTO visit_search (rowid, {', '.join(columns)}) "
+            f"VALUES (:visit_id, {', '.join(':' + column for column in columns)})"
+        ), values)
+
+
+def remove_visit(db, visit_id: int):
+    column = "visit_id" if _is_postgres(db.get_bind()) else "rowid"
+    db.execute(text(f"DELETE FROM visit_search WHERE {column} = :visit_id"), {"visit_id": visit_id})
+
+
+def rebuild_search_index(db, batch_size: int = 1000):
+    """Re-index every live and archived visit; returns the number indexed."""
+    indexed = 0
+    for model in (database.PatientVisit, database.PatientVisitArchive):
+        last_id = 0
+        while True:
+            batch = db.query(model).filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not batch:
+                break
+            for visit in batch:
+                index_visit(db, visit)
+            db.commit()
+            indexed += len(batch)
+            last_id = batch[-1].id
+    return indexed
+
+
+def encode_cursor(rank: float, visit_id: int):
+    raw = json.dumps({"r": rank, "id": visit_id}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        return float(data["r"]), int(data["id"])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+def _fts5_query(q: str):
+    # Quote every term so user input can never be parsed as FTS5 syntax
+    terms = re.findall(r"\w+", q)
+    return " ".join(f'"{term}"' for term in terms)
+
+
+def search_visits(db, q: str, start_date: Optional[date] = None, end_date: Optional[date] = None,
+                  doctor: Optional[str] = None, cursor: Optional[str] = None, limit: int = 20):
+    if not q or not re.search(r"\w", q):
+        raise ValueError("Search query must contain at least one word")
+
+    params = {"limit": limit + 1}
+    filters = []
+    if start_date:
+        filters.append("visit_date >= :start_date")
+        params["start_date"] = start_date if _is_postgres(db.get_bind()) else start_date.isoformat()
+    if end_date:
+        filters.append("visit_date <= :end_date")
+        params["end_date"] = end_date if _is_postgres(db.get_bind()) else end_date.isoformat()
+    if doctor:
+        filters.append("lower(doctor_name) = lower(:doctor)")
+        params["doctor"] = doctor
+    if cursor:
+        params["cursor_rank"], params["cursor_id"] = decode_cursor(cursor)
+        filters.append("(rank < :cursor_rank OR (rank = :cursor_rank AND visit_id < :cursor_id))")
+    where = "".join(f" AND {condition}" for condition in filters)
+
+    if _is_postgres(db.get_bind()):
+        params.update(q=q, language=SEARCH_LANGUAGE)
+        rows = db.execute(text(
+            "SELECT visit_id, patient_id, visit_date, doctor_name, rank,"
+            " ts_headline(CAST(:language AS regconfig), body, query,"
+            " 'MaxFragments=2, MinWords=5, MaxWords=20, StartSel=<b>, StopSel=</b>') AS snippet "
+            "FROM (SELECT s.visit_id, s.patient_id, s.visit_date, s.doctor_name, s.body, query,"
+            " ts_rank_cd(s.document, query) AS rank"
+            " FROM visit_search s, websearch_to_tsquery(CAST(:language AS regconfig), :q) AS query"
+            " WHERE s.document @@ query) hits "
+            f"WHERE TRUE{where} "
+            "ORDER BY rank DESC, visit_id DESC LIMIT :limit"
+        ), params).mappings().all()
+    else:
+        params["q"] = _fts5_query(q)
+        weights = ", ".join(str(weight) for _, weight in SEARCH_FIELDS.values())
+        hits = db.execute(text(
+            "SELECT * FROM (SELECT rowid AS visit_id, patient_id, visit_date, doctor_name,"
+            f" -bm25(visit_search, {weights}) AS rank"
+            " FROM visit_search WHERE visit_search MATCH :q) hits "
+            f"WHERE 1 = 1{where} "
+            "ORDER BY rank DESC, visit_id DESC LIMIT :limit"
+        ), params).mappings().all()
+        # Snippets only for the page being returned
+        snippets = {}
+        if hits:
+            ids = ", ".join(str(int(hit["visit_id"])) for hit in hits[:limit])
+            snippets = dict(db.execute(text(
+                "SELECT rowid, snippet(visit_search, -1, '<b>', '</b>', '…', 16) FROM visit_search "
+                f"WHERE visit_search MATCH :q AND rowid IN ({ids})"
+            ), {"q": params["q"]}).all())
+        rows = [dict(hit, snippet=snippets.get(hit["visit_id"], "")) for hit in hits]
+
+    items = [dict(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = items[-1]
+        next_cursor = encode_cursor(last["rank"], last["visit_id"])
+    return {"items": items, "next_cursor": next_cursor}
@@ -0,0 +1,258 @@
+"""
+Multi-clinic tenancy: one process serving several clinics, each with its own database.
+
+Every request is resolved to a tenant from the ``X-Tenant-ID`` header or,
+when TENANT_DOMAIN is set, from the subdomain (``<tenant>.<TENANT_DOMAIN>``).
+The tenant is kept in a context variable, which follows the request into
+threadpool endpoints, streamed responses and crud.py. Sessions opened via
+``get_db``/``get_write_db``/``session`` use that tenant's database.
+
+Database URLs come from TENANT_DATABASE_URLS (a JSON object of tenant -> URL,
+for clinics placed on their own database node) and otherwise from
+TENANT_DATABASE_URL_TEMPLATE, e.g. ``sqlite:///tenants/{tenant}.db``. A
+template tenant exists only when it is listed in TENANT_IDS or, on SQLite,
+when its database file exists. Requests never create databases or tables:
+``manage.py --tenant <id> init`` provisions a clinic (see ``provision``).
+An engine is created when a tenant is first used. At most TENANT_MAX_ENGINES
+engines are kept. The least recently used one is disposed of when another
+tenant needs a slot, so idle clinics do not hold connections.
+
+With neither setting the backend is single-tenant and everything uses
+``database.engine``, exactly as before.
+"""
+
+import contextvars
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+
+import database
+import partitioning
+import search
+
+TENANT_HEADER = os.getenv("TENANT_HEADER", "X-Tenant-ID")
+TENANT_DOMAIN = os.getenv("TENANT_DOMAIN")
+TENANT_DATABASE_URLS = json.loads(os.getenv("TENANT_DATABASE_URLS") or "{}")
+TENANT_DATABASE_URL_TEMPLATE = os.getenv("TENANT_DATABASE_URL_TEMPLATE")
+# Template tenants whose database is on a server, where it cannot be checked for cheaply
+TENANT_IDS = {tenant.strip().lower() for tenant in os.getenv("TENANT_IDS", "").split(",") if tenant.strip()}
+TENANT_MAX_ENGINES = int(os.getenv("TENANT_MAX_ENGINES", "32"))
+
+ENABLED = bool(TENANT_DATABASE_URLS or TENANT_DATABASE_URL_TEMPLATE)
+DEFAULT_TENANT = "default"
+
+# Paths that work without a tenant (docs and the welcome message)
+PUBLIC_PATHS = {"/", "/docs", "/docs/oauth2-redirect", "/redoc", "/openapi.json"}
+
+# Tenant ids end up in database URLs and file names
+TENANT_ID_PATTERN = re.compile(r"^[a-z0-9][a-z0-9_-]{0,62}$")
+
+_current_tenant = contextvars.ContextVar("tenant", default=None)
+
+
+class UnknownTenant(Exception):
+    pass
+
+
+class TenantDatabase:
+    def __init__(self, engine, session_local, write_session_local):
+        self.engine = engine
+        self.SessionLocal = session_local
+        self.WriteSessionLocal = write_session_local
+
+
+_default = TenantDatabase(database.engine, database.SessionLocal, database.WriteSessionLocal)
+_databases = OrderedDict()
+_databases_lock = threading.Lock()
+# Only one engine per tenant, even when several requests open it at once
+_create_lock = threading.Lock()
+
+
+def current_tenant():
+    return _current_tenant.get() if ENABLED else DEFAULT_TENANT
+
+
+def set_tenant(tenant):
+    return _current_tenant.set(tenant)
+
+
+def reset_tenant(token):
+    _current_tenant.reset(token)
+
+
+def database_url(tenant: str):
+    if tenant in TENANT_DATABASE_URLS:
+        return TENANT_DATABASE_URLS[tenant]
+    if TENANT_DATABASE_URL_TEMPLATE and TENANT_ID_PATTERN.match(tenant):
+        return TENANT_DATABASE_URL_TEMPLATE.format(tenant=tenant)
+    raise UnknownTenant(f"Unknown tenant '{tenant}'")
+
+
+def database_exists(url: str):
+    # Only SQLite files can be checked without connecting
+    url = make_url(url)
+    if url.get_backend_name() != "sqlite":
+        return True
+    return bool(url.database) and url.database != ":memory:" and os.path.exists(url.database)
+
+
+def is_known(tenant: str):
+    try:
+        url = database_url(tenant)
+    except UnknownTenant:
+        return False
+    if tenant in TENANT_DATABASE_URLS or tenant in TENANT_IDS:
+        return True
+    # Any id fits the template; only clinics provisioned already count
+    return make_url(url).get_backend_name() == "sqlite" and database_exists(url)
+
+
+def initialize_database(engine):
+    """Create tables, upcoming partitions and the search index on a database."""
+    database.create_tables(engine)
+    partitioning.ensure_partitions(engine)
+    search.ensure_search_index(engine)
+
+
+def provision(tenant: str):
+    """Create or upgrade a tenant's tables; run from manage.py, never from a request."""
+    url = database_url(tenant)
+    path = make_url(url).database
+    if make_url(url).get_backend_name() == "sqlite" and path and path != ":memory:":
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    engine = database.make_engine(url)
+    try:
+        initialize_database(engine)
+    finally:
+        engine.dispose()
+
+
+def get_database(tenant=None):
+    if not ENABLED:
+        return _default
+    tenant = tenant or _current_tenant.get()
+    if tenant is None:
+        raise UnknownTenant("No tenant given")
+
+    with _databases_lock:
+        tenant_db = _databases.get(tenant)
+        if tenant_db is not None:
+            _databases.move_to_end(tenant)
+            return tenant_db
+
+    with _create_lock:
+        with _databases_lock:
+            tenant_db = _databases.get(tenant)
+        if tenant_db is None:
+            if not is_known(tenant):
+                raise UnknownTenant(f"Unknown tenant '{tenant}'")
+            engine = database.make_engine(database_url(tenant))
+            tenant_db = TenantDatabase(
+                engine,
+                sessionmaker(autocommit=False, autoflush=False, bind=engine),
+                sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine.execution_options(writer=True))
+            )
+
+    evicted = []
+    with _databases_lock:
+        _databases[tenant] = tenant_db
+        _databases.move_to_end(tenant)
+        while len(_databases) > TENANT_MAX_ENGINES:
+            evicted.append(_databases.popitem(last=False)[1])
+    for old in evicted:
+        # Checked-out connections finish their work and are closed on return
+        old.engine.dispose()
+    return tenant_db
+
+
+def get_engine(tenant=None):
+    return get_database(tenant).engine
+
+
+def session(tenant=None, write: bool = False):
+    tenant_db = get_database(tenant)
+    return tenant_db.WriteSessionLocal() if write else tenant_db.SessionLocal()
+
+
+@contextmanager
+def write_session(tenant=None):
+    db = session(tenant, write=True)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# Database dependencies for the current request's tenant
+def get_db():
+    db = session()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_write_db():
+    with write_session() as db:
+        yield db
+
+
+def dispose_all(close: bool = True):
+    with _databases_lock:
+        tenant_dbs = list(_databases.values())
+        if close:
+            _databases.clear()
+    for tenant_db in tenant_dbs + [_default]:
+        tenant_db.engine.dispose(close=close)
+
+
+def resolve_tenant(headers, host: str = ""):
+    tenant = headers.get(TENANT_HEADER.lower())
+    if not tenant and TENANT_DOMAIN:
+        hostname = host.split(":", 1)[0].lower()
+        if hostname.endswith("." + TENANT_DOMAIN):
+            tenant = hostname[:-len(TENANT_DOMAIN) - 1]
+    return tenant.strip().lower() if tenant else None
+
+
+class TenantMiddleware:
+    """Pure ASGI middleware that resolves the tenant and rejects unknown ones."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+        tenant = resolve_tenant(headers, headers.get("host", ""))
+        if tenant is None and scope["path"] not in PUBLIC_PATHS:
+            await _reject(send, 400, f"Missing tenant: send the {TENANT_HEADER} header")
+            return
+        if tenant is not None and not (TENANT_ID_PATTERN.match(tenant) and is_known(tenant)):
+            await _reject(send, 404, "Unknown tenant")
+            return
+
+        token = set_tenant(tenant)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            reset_tenant(token)
+
+
+async def _reject(send, status: int, detail: str):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,92 @@
+"""
+Normalized terms from the free-text prescription fields of visits.
+
+``medicines``, ``diagnosis`` and ``tests`` are typed free-form, for example
+``"Tab. Paracetamol 500mg 1-0-1 x 5 days, Cetirizine 10 mg"``. Whenever crud.py
+creates, updates or deletes a visit, these fields are split into one entry
+per item and normalized, here to ``paracetamol`` and ``cetirizine``. Each term
+is stored as a row of the ``visit_terms`` side table, together with the visit
+date and doctor. Frequency and trend analytics then become grouped scans
+over the (field, term, visit_date) index, with no text parsing at query time.
+
+Like the search index, terms of archived visits are kept, so the analytics
+cover them too.
+"""
+
+import re
+
+import database
+
+TERM_FIELDS = ("medicines", "diagnosis", "tests")
+MAX_TERM_LENGTH = 200
+
+# Items are separated by commas, semicolons, newlines or list bullets
+_SEPARATORS = re.compile(r"[,;\n\r•]+|\s+\+\s+")
+_LIST_MARKER = re.compile(r"^\s*(?:\d+[.)]|[-*])\s*")
+# Dosage forms written before the medicine name
+_FORM_PREFIX = re.compile(
+    r"^(?:tab|tabs|tablet|cap|caps|capsule|syp|syr|syrup|inj|injection|oint|ointment|"
+    r"cream|gel|drops?|susp|suspension|lotion|sachet|inh|inhaler)\b\.?\s*"
+)
+# Strength, frequency and duration: "500mg", "1-0-1", "bd", "x 5 days"
+_DOSAGE = re.compile(
+    r"\b\d+(?:\.\d+)?\s*(?:mg|mcg|µg|g|gm|ml|iu|units?|%)(?=\W|$)"
+    r"|\b\d+(?:/\d+)?\s*-\s*\d+(?:/\d+)?\s*-\s*\d+(?:/\d+)?\b"
+    r"|\b(?:od|bd|bid|tds|tid|qid|hs|sos|stat|prn|qhs|ac|pc)\b"
+    r"|(?:\bx|\bfor)\s*\d+\s*(?:days?|weeks?|months?|d|w)\b"
+    r"|\b\d+\s*(?:days?|weeks?|months?)\b"
+)
+
+
+def normalize_terms(field: str, value):
+    """Split a free-text field into unique, lower-cased terms, in order of appearance."""
+    if not value:
+        return []
+    terms = []
+    for item in _SEPARATORS.split(value):
+        term = _LIST_MARKER.sub("", item).lower()
+        if field == "medicines":
+            term = _FORM_PREFIX.sub("", term.strip())
+            term = _DOSAGE.sub(" ", term)
+        term = re.sub(r"\s+", " ", term).strip(" .:-()[]")
+        if term and not term.isdigit() and term not in terms:
+            terms.append(term[:MAX_TERM_LENGTH])
+    return terms
+
+
+def index_visit(db, visit):
+    """Replace a visit's terms, inside the caller's transaction."""
+    remove_visit(db, visit.id)
+    db.add_all(
+        database.VisitTerm(
+            visit_id=visit.id,
+            patient_id=visit.patient_id,
+            field=field,
+            term=term,
+            visit_date=visit.visit_date,
+            doctor_name=visit.doctor_name
+        )
+        for field in TERM_FIELDS
+        for term in normalize_terms(field, getattr(visit, field))
+    )
+
+
+def remove_visit(db, visit_id: int):
+    db.query(database.VisitTerm).filter(database.VisitTerm.visit_id == visit_id).delete(synchronize_session=False)
+
+
+def rebuild_terms(db, batch_size: int = 1000):
+    """Re-extract terms for every live and archived visit; returns the number of visits processed."""
+    processed = 0
+    for model in (database.PatientVisit, database.PatientVisitArchive):
+        last_id = 0
+        while True:
+            batch = db.query(model).filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not batch:
+                break
+            for visit in batch:
+                index_visit(db, visit)
+            db.commit()
+            processed += len(batch)
+            last_id = batch[-1].id
+    return processed